@@ -0,0 +1,56 @@
+from array import array
+from math import sin, pi
+from os import path
+from sys import argv, path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from converter import batches
+from encoders import ENCODERS
+
+SETTINGS = {"frequency": "22050", "channels": "2", "batch_size": 16}
+CLIP_SECONDS = 2
+CLIPS = 50
+
+
+def make_clip(seconds, frequency=22050, channels=2, tone=440.0):
+    samples = array('h', (int(8000 * sin(2 * pi * tone * index / frequency))
+                          for index in range(seconds * frequency) for _ in range(channels)))
+    return samples.tobytes()
+
+
+if __name__ == "__main__":
+    clips = int(argv[1]) if len(argv) > 1 else CLIPS
+    data = make_clip(CLIP_SECONDS)
+    print("{} clips of {}s s16le, {} Hz, {} channels".format(clips, CLIP_SECONDS, SETTINGS["frequency"], SETTINGS["channels"]))
+    print("{:>6} {:>12} {:>10}".format("format", "backend", "files/s"))
+    with TemporaryDirectory() as tmp:
+        resources = []
+        for index in range(clips):
+            resources.append(path.join(tmp, str(index)))
+            with open(resources[-1], 'wb') as resource:
+                resource.write(data)
+        for audio_format in ('flac', 'mp3'):
+            for encoder_class in ENCODERS:
+                if audio_format not in encoder_class.formats:
+                    continue
+                if not encoder_class.available(audio_format):
+                    print("{:>6} {:>12} {:>10}".format(audio_format, encoder_class.name, "n/a"))
+                    continue
+                encoder = encoder_class(audio_format, SETTINGS)
+                jobs = [(resource, resource + '.' + audio_format) for resource in resources]
+                runs = [(encoder.name, [[job] for job in jobs])]
+                if encoder.batch_size > 1:
+                    runs.append(("{} x{}".format(encoder.name, encoder.batch_size), list(batches(jobs, encoder.batch_size))))
+                for name, run in runs:
+                    start = perf_counter()
+                    try:
+                        for batch in run:
+                            if not all(encoder.convert_batch(batch)):
+                                raise RuntimeError("{} failed on {}".format(name, batch[0][0]))
+                    except (OSError, RuntimeError) as error:
+                        print("{:>6} {:>12} {:>10}".format(audio_format, name, "error"), error)
+                        continue
+                    print("{:>6} {:>12} {:>10.1f}".format(audio_format, name, clips / (perf_counter() - start)))
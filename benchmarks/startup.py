@@ -0,0 +1,67 @@
+from os import path, makedirs, environ
+from statistics import median
+from sys import argv, exit, executable
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import subprocess
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+RUNS = 5
+# Wall-clock budgets in seconds, interpreter start-up included. A run with
+# nothing to convert should be over before anyone notices it started.
+BUDGETS = {"cli --help": 0.35, "cli no-op": 0.6, "gui first window": 1.0}
+
+# Shows the window, lets Qt paint it once and leaves without waiting for the
+# encoder probe running in the background.
+GUI_SCRIPT = """
+import os
+from PyQt5.QtWidgets import QApplication, QWidget
+from raw2flac_gui import MainWindow
+app = QApplication([])
+win = QWidget()
+ui = MainWindow(win)
+win.show()
+app.processEvents()
+os._exit(0)
+"""
+
+
+def timed(command, env=None):
+    start = perf_counter()
+    subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return perf_counter() - start
+
+
+def make_tree(source_root, destination_root):
+    makedirs(path.join(source_root, '0000001'))
+    with open(path.join(source_root, '0000001', '0000001.raw'), 'wb') as resource:
+        resource.write(bytes(4 * 22050))
+    subprocess.run([executable, 'raw2flac.py', source_root, destination_root, 'flac', '-y'], cwd=ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+if __name__ == "__main__":
+    runs = int(argv[1]) if len(argv) > 1 else RUNS
+    failed = False
+    with TemporaryDirectory() as tmp:
+        source_root = path.join(tmp, 'result')
+        destination_root = path.join(tmp, 'result_flac')
+        make_tree(source_root, destination_root)
+        commands = {"cli --help": ([executable, 'raw2flac.py', '--help'], None),
+                    "cli no-op": ([executable, 'raw2flac.py', source_root, destination_root, 'flac', '-y'], None),
+                    "gui first window": ([executable, '-c', GUI_SCRIPT],
+                                         dict(environ, QT_QPA_PLATFORM='offscreen'))}
+        print("{:>18} {:>8} {:>8}".format("startup", "median", "budget"))
+        for name, (command, env) in commands.items():
+            try:
+                elapsed = median(timed(command, env) for _ in range(runs))
+            except (OSError, subprocess.CalledProcessError) as error:
+                print("{:>18} failed: {}".format(name, error))
+                failed = True
+                continue
+            print("{:>18} {:>7.0f}ms {:>7.0f}ms".format(name, elapsed * 1000, BUDGETS[name] * 1000))
+            if elapsed > BUDGETS[name]:
+                print("\t{} is over its budget".format(name))
+                failed = True
+    exit(1 if failed else 0)
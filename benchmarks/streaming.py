@@ -0,0 +1,85 @@
+from os import path
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from sys import argv, exit, executable, path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import json
+import subprocess
+
+sys_path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from encoders import CHUNK_SIZE, ENCODERS
+from benchmarks.encoders import make_clip
+
+SETTINGS = {"frequency": "22050", "channels": "2"}
+CAPTURE_MB = 256
+# Resident memory must not grow with the capture: a few chunks in flight
+# (read buffer, carried frames, encoder output) plus the encoder's own state
+# is all streaming needs. ffmpeg reads the file itself, so its process is
+# held to a ceiling of its own.
+MEMORY_CEILING = 32 * CHUNK_SIZE
+FFMPEG_CEILING = 128 * CHUNK_SIZE
+
+
+def make_capture(capture_path, size):
+    second = make_clip(1)
+    with open(capture_path, 'wb') as capture:
+        written = 0
+        while written < size:
+            capture.write(second)
+            written += len(second)
+    return written
+
+
+def max_rss(who):
+    # ru_maxrss is in kilobytes on Linux.
+    return getrusage(who).ru_maxrss * 1024
+
+
+def measure(encoder_name, audio_format, capture_path):
+    # Runs in a process of its own, so that the peak resident size is this
+    # conversion's and not that of an earlier one. The encoder's module is
+    # imported before the baseline is taken.
+    encoder_class = next(encoder for encoder in ENCODERS if encoder.name == encoder_name)
+    if not encoder_class.available(audio_format):
+        return None
+    encoder = encoder_class(audio_format, SETTINGS)
+    baseline = max_rss(RUSAGE_SELF)
+    start = perf_counter()
+    converted = encoder.convert(capture_path, capture_path + '.' + audio_format)
+    elapsed = perf_counter() - start
+    return {"converted": converted, "seconds": elapsed, "growth": max_rss(RUSAGE_SELF) - baseline,
+            "child": max_rss(RUSAGE_CHILDREN)}
+
+
+def run(encoder_name, audio_format, capture_path):
+    out = subprocess.run([executable, path.realpath(__file__), '--measure', encoder_name, audio_format, capture_path],
+                         stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(out)
+
+
+if __name__ == "__main__":
+    if argv[1:2] == ['--measure']:
+        print(json.dumps(measure(*argv[2:5])))
+        exit(0)
+    size = int(argv[1] if len(argv) > 1 else CAPTURE_MB) << 20
+    failed = False
+    with TemporaryDirectory() as tmp:
+        capture_path = path.join(tmp, 'capture')
+        size = make_capture(capture_path, size)
+        print("capture of {:.0f} MB, rss growth ceiling {:.0f} MB, ffmpeg ceiling {:.0f} MB".format(
+            size / 2 ** 20, MEMORY_CEILING / 2 ** 20, FFMPEG_CEILING / 2 ** 20))
+        print("{:>6} {:>10} {:>8} {:>12} {:>12}".format("format", "backend", "seconds", "rss growth", "child rss"))
+        for encoder_class in ENCODERS:
+            for audio_format in encoder_class.formats:
+                result = run(encoder_class.name, audio_format, capture_path)
+                if result is None:
+                    continue
+                print("{:>6} {:>10} {:>8.1f} {:>10.1f}MB {:>10.1f}MB".format(
+                    audio_format, encoder_class.name, result["seconds"], result["growth"] / 2 ** 20,
+                    result["child"] / 2 ** 20))
+                if not result["converted"] or result["growth"] > MEMORY_CEILING or result["child"] > FFMPEG_CEILING:
+                    print("\t{} {} exceeded the memory ceiling or failed".format(audio_format, encoder_class.name))
+                    failed = True
+    exit(1 if failed else 0)
@@ -0,0 +1,249 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from os import path, makedirs, cpu_count
+from platform import platform, python_version
+from resource import getrusage, RUSAGE_SELF
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import json
+
+sys_path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from benchmarks.encoders import make_clip
+from converter import default_workers
+from encoders import ENCODERS, get_encoder
+from pipeline import convert_all
+from manifest import diff_manifest
+from planner import plan_conversion
+from tree_diff import scan_tree, diff_trees
+
+SETTINGS = {"frequency": "22050", "channels": "2", "batch_size": 16}
+SCALES = {
+    # tiny files, seconds per tiny file, huge files, MB per huge file,
+    # KIM tree depth, directories per level, files per KIM directory
+    'small': (500, 0.5, 1, 16, 3, 3, 10),
+    'medium': (5000, 0.5, 2, 64, 4, 3, 20),
+    'large': (50000, 0.5, 2, 512, 5, 4, 20),
+}
+ENCODE_SAMPLE = 200
+# Length of the KIM corpus captures, which only matter to scans and diffs.
+DEEP_SECONDS = 0.01
+FILES_PER_DIR = 100
+
+
+def encoded(data):
+    # What converting data leaves in the destination: the converted half of a
+    # corpus has to hold real outputs, or the manifest won't adopt them.
+    with TemporaryDirectory() as tmp:
+        output_path = path.join(tmp, 'output.flac')
+        get_encoder('flac', SETTINGS).encode(data, output_path)
+        with open(output_path, 'rb') as output:
+            return output.read()
+
+
+def make_tiny(root, count, seconds, converted_root):
+    clip = make_clip(1)[:int(seconds * 22050) * 4]
+    converted = encoded(clip)
+    for index in range(count):
+        directory = str(1000000 + index // FILES_PER_DIR)
+        makedirs(path.join(root, directory), exist_ok=True)
+        with open(path.join(root, directory, str(index)), 'wb') as resource:
+            resource.write(clip)
+        if index % 2 == 0:
+            makedirs(path.join(converted_root, directory), exist_ok=True)
+            with open(path.join(converted_root, directory, str(index)) + '.flac', 'wb') as output:
+                output.write(converted)
+
+
+def make_huge(root, count, megabytes):
+    second = make_clip(1)
+    makedirs(root, exist_ok=True)
+    for index in range(count):
+        with open(path.join(root, 'capture{}'.format(index)), 'wb') as resource:
+            for _ in range((megabytes << 20) // len(second) + 1):
+                resource.write(second)
+
+
+def make_deep(root, depth, fan_out, files, converted_root, relroot='', counter=None, contents=None):
+    # Nested ^[0-9]{7}$ directories, as written by KIM capture nodes.
+    counter = counter if counter is not None else [1000000]
+    if contents is None:
+        capture = make_clip(1)[:int(DEEP_SECONDS * 22050) * 4]
+        contents = capture, encoded(capture)
+    if depth == 0:
+        return
+    for _ in range(fan_out):
+        counter[0] += 1
+        relpath = path.join(relroot, str(counter[0])) if relroot else str(counter[0])
+        makedirs(path.join(root, relpath), exist_ok=True)
+        for filename in range(files):
+            with open(path.join(root, relpath, str(filename)), 'wb') as resource:
+                resource.write(contents[0])
+            if filename % 2 == 0:
+                makedirs(path.join(converted_root, relpath), exist_ok=True)
+                with open(path.join(converted_root, relpath, str(filename)) + '.flac', 'wb') as output:
+                    output.write(contents[1])
+        make_deep(root, depth - 1, fan_out, files, converted_root, relpath, counter, contents)
+
+
+def build_plan(source_root, destination_root, extension):
+    # The GUI's scan and convert: one planning pass, then the batched
+    # destination directory creation.
+    plan = plan_conversion(source_root, destination_root, extension, duplicates=True)
+    plan.make_dirs()
+    return len(plan.jobs)
+
+
+def encode_files(encoder_class, audio_format, resources, destination_root):
+    encoder = encoder_class(audio_format, SETTINGS)
+    makedirs(destination_root, exist_ok=True)
+    jobs = [(resource, path.join(destination_root, path.basename(resource)) + '.' + audio_format)
+            for resource in resources]
+    converted = 0
+    for batch_start in range(0, len(jobs), encoder.batch_size):
+        converted += sum(encoder.convert_batch(jobs[batch_start:batch_start + encoder.batch_size]))
+    return converted
+
+
+def convert_mixed(encoder_class, audio_format, resources, destination_root, pipeline):
+    # Small captures and a few huge ones, largest first, through the worker
+    # pool or the staged read/encode/write pipeline.
+    encoder = encoder_class(audio_format, SETTINGS)
+    makedirs(destination_root, exist_ok=True)
+    jobs = [(resource, path.join(destination_root, path.basename(resource)) + '.' + audio_format)
+            for resource in sorted(resources, key=path.getsize, reverse=True)]
+    converted = []
+    settings = dict(SETTINGS, workers=default_workers(), pipeline=pipeline)
+    convert_all(jobs, encoder, settings, on_success=lambda *job: converted.append(job))
+    return len(converted)
+
+
+def _isolated(function, args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start, getrusage(RUSAGE_SELF).ru_maxrss
+
+
+def measure(name, function, *args, files=0, nbytes=0):
+    # Every measurement runs in a fresh process so that peak RSS belongs to it.
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        result, seconds, max_rss = executor.submit(_isolated, function, args).result()
+    entry = {
+        'name': name,
+        'seconds': seconds,
+        'files': files,
+        'bytes': nbytes,
+        'files_per_second': files / seconds if seconds else 0.0,
+        'mb_per_second': nbytes / 2 ** 20 / seconds if seconds else 0.0,
+        'peak_rss_mb': max_rss / 1024,
+        'result': result,
+    }
+    print("{:<34} {:>9.3f}s {:>11.1f} {:>9.2f} {:>9.1f}".format(
+        name, seconds, entry['files_per_second'], entry['mb_per_second'], entry['peak_rss_mb']))
+    return entry
+
+
+def tree_size(root):
+    index = scan_tree(root, stat=True)
+    return len(index.files), sum(size for size, _ in index.stats.values())
+
+
+def run(scale, backends):
+    tiny, tiny_seconds, huge, huge_mb, depth, fan_out, kim_files = SCALES[scale]
+    results = []
+    print("{:<34} {:>10} {:>11} {:>9} {:>9}".format("benchmark", "time", "files/s", "MB/s", "RSS MB"))
+    with TemporaryDirectory() as tmp:
+        corpora = {
+            'tiny': (path.join(tmp, 'tiny'), path.join(tmp, 'tiny_flac')),
+            'deep': (path.join(tmp, 'deep'), path.join(tmp, 'deep_flac')),
+            'huge': (path.join(tmp, 'huge'), path.join(tmp, 'huge_flac')),
+        }
+        make_tiny(corpora['tiny'][0], tiny, tiny_seconds, corpora['tiny'][1])
+        make_deep(corpora['deep'][0], depth, fan_out, kim_files, corpora['deep'][1])
+        make_huge(corpora['huge'][0], huge, huge_mb)
+        for corpus in ('tiny', 'deep'):
+            source, destination = corpora[corpus]
+            files, nbytes = tree_size(source)
+            results.append(measure('scan/' + corpus, scan_count, source, files=files, nbytes=nbytes))
+            results.append(measure('diff/' + corpus, diff_count, source, destination, files=files, nbytes=nbytes))
+            results.append(measure('diff-manifest/' + corpus, manifest_count, source, destination, files=files, nbytes=nbytes))
+            # Both diffs have to find the same work for their times to compare.
+            assert results[-1]['result'] == results[-2]['result'], (corpus, results[-2:])
+            results.append(measure('plan/' + corpus, build_plan, source, destination, '.flac', files=files, nbytes=nbytes))
+        tiny_sample = sorted(scan_tree(corpora['tiny'][0]).files)[:ENCODE_SAMPLE]
+        tiny_sample = [path.join(corpora['tiny'][0], relpath) for relpath in tiny_sample]
+        huge_files = [path.join(corpora['huge'][0], relpath) for relpath in scan_tree(corpora['huge'][0]).files]
+        for encoder_class in ENCODERS:
+            if backends and encoder_class.name not in backends:
+                continue
+            if not encoder_class.available():
+                print("{:<34} {:>10}".format('encode/' + encoder_class.name, "n/a"))
+                continue
+            for audio_format in encoder_class.formats:
+                if not encoder_class.available(audio_format):
+                    continue
+                for corpus, resources in (('tiny', tiny_sample), ('huge', huge_files)):
+                    nbytes = sum(path.getsize(resource) for resource in resources)
+                    name = 'encode/{}/{}/{}'.format(encoder_class.name, audio_format, corpus)
+                    results.append(measure(name, encode_files, encoder_class, audio_format, resources,
+                                           path.join(tmp, name.replace('/', '_')), files=len(resources), nbytes=nbytes))
+                if not encoder_class.staged:
+                    continue
+                mixed = tiny_sample + huge_files
+                nbytes = sum(path.getsize(resource) for resource in mixed)
+                for pipeline in (False, True):
+                    name = 'convert/{}/{}/{}'.format('pipeline' if pipeline else 'pool', encoder_class.name, audio_format)
+                    results.append(measure(name, convert_mixed, encoder_class, audio_format, mixed,
+                                           path.join(tmp, name.replace('/', '_')), pipeline, files=len(mixed), nbytes=nbytes))
+    return results
+
+
+def scan_count(source):
+    return len(scan_tree(source, stat=True).files)
+
+
+def diff_count(source, destination):
+    return len(diff_trees(source, destination, '.flac').new_files)
+
+
+def manifest_count(source, destination):
+    return len(diff_manifest(source, destination, '.flac').new_files)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {entry['name']: entry for entry in json.load(baseline_file)['results']}
+    print("\n{:<34} {:>10} {:>10} {:>8}".format("compared to " + path.basename(baseline_path), "before", "after", "change"))
+    for entry in results:
+        before = baseline.get(entry['name'])
+        if before is None or not before['seconds']:
+            continue
+        change = (entry['seconds'] - before['seconds']) / before['seconds'] * 100
+        print("{:<34} {:>9.3f}s {:>9.3f}s {:>+7.1f}%".format(entry['name'], before['seconds'], entry['seconds'], change))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark scan, diff, planning and encoding on synthetic s16le corpora.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--backend', action='append', help="only benchmark these encoder backends")
+    parser.add_argument('--output', default='bench_output.json', help="results file (default: %(default)s)")
+    parser.add_argument('--compare', help="a previous results file to compare against")
+    args = parser.parse_args()
+    results = run(args.scale, args.backend)
+    with open(args.output, 'w') as output:
+        json.dump({
+            'scale': args.scale,
+            'corpus': dict(zip(('tiny_files', 'tiny_seconds', 'huge_files', 'huge_mb', 'kim_depth', 'kim_fan_out', 'kim_files'),
+                               SCALES[args.scale])),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': python_version(),
+            'platform': platform(),
+            'cpus': cpu_count(),
+            'results': results,
+        }, output, indent=2)
+    print("\nResults written to {}".format(args.output))
+    if args.compare:
+        compare(results, args.compare)
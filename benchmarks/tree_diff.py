@@ -0,0 +1,58 @@
+from os import path, makedirs, walk
+from sys import argv, path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from tree_diff import diff_trees
+
+SIZES = [1000, 10000, 50000]
+FILES_PER_DIR = 100
+LEGACY_LIMIT = 10000
+
+
+def make_tree(root, size, converted_root=None, extension='.flac'):
+    for index in range(size):
+        relpath = path.join(str(1000000 + index // FILES_PER_DIR), str(index))
+        makedirs(path.join(root, path.dirname(relpath)), exist_ok=True)
+        open(path.join(root, relpath), 'wb').close()
+        if converted_root is not None and index % 2 == 0:
+            makedirs(path.join(converted_root, path.dirname(relpath)), exist_ok=True)
+            open(path.join(converted_root, relpath) + extension, 'wb').close()
+
+
+def legacy_diff(source_root, destination_root, extension):
+    result_files = []
+    for root, _, files in walk(source_root):
+        for filename in files:
+            result_files.append(path.relpath(path.join(root, filename), start=source_root))
+    result_converted_files = []
+    for root, _, files in walk(destination_root):
+        for filename in files:
+            if filename.endswith(extension):
+                result_converted_files.append(path.relpath(path.join(root, filename), start=destination_root))
+    return [file for file in result_files if not file + extension in result_converted_files]
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    print("{:>8} {:>12} {:>12}".format("files", "diff_trees", "list scan"))
+    for size in sizes:
+        with TemporaryDirectory() as tmp:
+            source = path.join(tmp, 'Result')
+            destination = path.join(tmp, 'Result_flac')
+            make_tree(source, size, destination)
+            elapsed, diff = timed(diff_trees, source, destination, '.flac')
+            assert len(diff.new_files) == size // 2
+            if size <= LEGACY_LIMIT:
+                legacy = "{:.3f}s".format(timed(legacy_diff, source, destination, '.flac')[0])
+            else:
+                legacy = "skipped"
+            print("{:>8} {:>11.3f}s {:>12}".format(size, elapsed, legacy))
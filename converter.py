@@ -0,0 +1,94 @@
+from os import cpu_count, path
+from time import perf_counter
+
+from metrics import FileMetrics, begin_measure, end_measure
+
+
+def default_workers():
+    return cpu_count() or 1
+
+
+def batches(jobs, batch_size):
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _timed(convert_batch, batch):
+    start = perf_counter()
+    timings = begin_measure()
+    try:
+        results = convert_batch(batch)
+    except Exception:
+        results = [False] * len(batch)
+    finally:
+        end_measure()
+    return results, start, perf_counter() - start, timings
+
+
+def _size(file_path):
+    # Fan-out jobs (encoders.FanoutEncoder) have a tuple of outputs.
+    if isinstance(file_path, tuple):
+        return sum(_size(output) for output in file_path if output is not None)
+    try:
+        return path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def convert_files(jobs, convert, workers=1, on_success=None, on_failure=None, should_stop=None,
+                  batch_size=1, convert_batch=None, on_result=None, metrics=None, on_start=None):
+    # Run convert(resourcePath, destinationPath) for every job with at most
+    # `workers` conversions in flight. Callbacks fire in the calling thread.
+    # Once should_stop() is true no new jobs are started, but running ones are
+    # allowed to finish. Returns True only when every job has been processed.
+    # With convert_batch, jobs are handed over batch_size at a time and
+    # convert_batch(jobs) returns one result per job. With on_result or a
+    # metrics.RunMetrics, a FileMetrics is built for every job; a batch's
+    # timings are split evenly between its jobs. on_start is called for every
+    # job just before it is handed to the pool.
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    workers = max(1, int(workers))
+    if convert_batch is None or int(batch_size) <= 1:
+        batch_size = 1
+        convert_batch = lambda batch: [convert(*batch[0])]
+    pending = batches(jobs, int(batch_size))
+    started = perf_counter()
+    running = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            stopping = should_stop is not None and should_stop()
+            while not stopping and not exhausted and len(running) < workers:
+                batch = next(pending, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    if on_start is not None:
+                        for job in batch:
+                            on_start(*job)
+                    running[executor.submit(_timed, convert_batch, batch)] = batch
+            if not running:
+                return exhausted and not stopping
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                results, start, seconds, timings = future.result()
+                share = 1 / len(batch)
+                for job, converted in zip(batch, results):
+                    callback = on_success if converted else on_failure
+                    if callback is not None:
+                        callback(*job)
+                    if on_result is not None or metrics is not None:
+                        file_metrics = FileMetrics(job[0], job[1], converted, start - started, seconds * share,
+                                                   {stage: value * share for stage, value in timings.items()},
+                                                   _size(job[0]), _size(job[1]) if converted else 0)
+                        if metrics is not None:
+                            metrics.add(file_metrics)
+                        if on_result is not None:
+                            on_result(file_metrics)
@@ -0,0 +1,263 @@
+from collections import deque
+from itertools import count
+from os import getpid, path
+from threading import Lock, Event, Thread
+from time import monotonic, sleep
+
+import hmac
+import json
+import re
+import socket
+
+from encoders import get_encoder
+from journal import JournalJob
+from pipeline import convert_all
+from planner import plan_jobs
+
+LEASE_SIZE = 16
+LEASE_TIMEOUT = 600.0
+RETRY_INTERVAL = 2.0
+TOKEN_HEADER = 'X-Raw2flac-Token'
+
+
+class Coordinator:
+    # Hands the jobs of a plan out in leases of lease_size jobs. A lease that
+    # is not reported within lease_timeout seconds goes back to the front of
+    # the queue, so the files of a dead worker are converted by another one.
+    # A late report of an expired lease still counts for jobs not done yet,
+    # but its other jobs were requeued when it expired and are not again.
+    # Every process writes its own partial output (encoders.partial_path), so
+    # two workers holding the same job never share a file. A report only
+    # counts for the jobs of the lease it names.
+
+    def __init__(self, jobs, lease_size=LEASE_SIZE, lease_timeout=LEASE_TIMEOUT, on_lease=None,
+                 on_success=None, on_failure=None):
+        self.jobs = {job.source: job for job in jobs}
+        self.pending = deque(self.jobs.values())
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.on_lease = on_lease
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.leases = {}
+        self.expired = {}
+        self.finished = set()
+        self.done = Event()
+        self._ids = count(1)
+        self._lock = Lock()
+        if not self.jobs:
+            self.done.set()
+
+    def _requeue(self, jobs):
+        self.pending.extendleft(reversed([job for job in jobs if job.source not in self.finished]))
+
+    def lease(self, worker):
+        with self._lock:
+            now = monotonic()
+            for lease_id, (jobs, deadline, _) in list(self.leases.items()):
+                if deadline <= now:
+                    del self.leases[lease_id]
+                    self.expired[lease_id] = jobs
+                    self._requeue(jobs)
+            jobs = []
+            while self.pending and len(jobs) < self.lease_size:
+                job = self.pending.popleft()
+                if job.source not in self.finished:
+                    jobs.append(job)
+            if not jobs:
+                return None, []
+            lease_id = next(self._ids)
+            self.leases[lease_id] = (jobs, now + self.lease_timeout, worker)
+            if self.on_lease is not None:
+                self.on_lease(worker, jobs)
+            return lease_id, jobs
+
+    def report(self, lease_id, converted, failed):
+        # Jobs of the lease that are in neither list (the worker was stopped)
+        # are handed out again right away.
+        with self._lock:
+            active = lease_id in self.leases
+            if active:
+                jobs, _, _ = self.leases.pop(lease_id)
+            else:
+                jobs = self.expired.pop(lease_id, [])
+            leased = {job.source for job in jobs}
+            for sources, callback in ((converted, self.on_success), (failed, self.on_failure)):
+                for source in sources:
+                    job = self.jobs.get(source) if source in leased else None
+                    if job is None or source in self.finished:
+                        continue
+                    self.finished.add(source)
+                    if callback is not None:
+                        callback(job)
+            if active:
+                self._requeue(jobs)
+            if len(self.finished) == len(self.jobs):
+                self.done.set()
+
+    def status(self):
+        with self._lock:
+            leased = sum(1 for jobs, _, _ in self.leases.values() for job in jobs if job.source not in self.finished)
+            return {'pending': len(self.jobs) - len(self.finished) - leased, 'leased': leased,
+                    'finished': len(self.finished)}
+
+
+def _handler(coordinator, output, token):
+    # http.server and urllib are imported only where they are used, so runs
+    # that never coordinate do not pay for them (and ssl) at start-up.
+    from http.server import BaseHTTPRequestHandler
+
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+        # POST /lease {"worker": name} -> {"lease": id, "output": ..., "jobs": [...]}
+        #   where output is the run's journal.output_settings()
+        # POST /report {"lease": id, "converted": [...], "failed": [...]}
+        # GET /status
+        # Every request carries the shared token in the X-Raw2flac-Token header.
+
+        def _authorized(self):
+            if hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode(), token.encode()):
+                return True
+            self._reply({'error': 'unauthorized'}, 401)
+            return False
+
+        def _reply(self, body, status=200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path == '/status':
+                self._reply(coordinator.status())
+            else:
+                self._reply({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            except ValueError:
+                self._reply({'error': 'invalid json'}, 400)
+                return
+            if self.path == '/lease':
+                lease_id, jobs = coordinator.lease(body.get('worker') or self.client_address[0])
+                self._reply({'lease': lease_id, 'output': output, 'jobs': [list(job) for job in jobs],
+                             'finished': coordinator.done.is_set()})
+            elif self.path == '/report':
+                coordinator.report(body.get('lease'), body.get('converted', []), body.get('failed', []))
+                self._reply({'finished': coordinator.done.is_set()})
+            else:
+                self._reply({'error': 'not found'}, 404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return CoordinatorHandler
+
+
+def serve_coordinator(coordinator, output, host, port, token, ready=None):
+    # Serves leases until every job is converted or failed, to workers that
+    # send token. output (journal.output_settings) tells the workers what to
+    # convert to. ready(address) is called once the server listens, e.g. to
+    # start local workers.
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), _handler(coordinator, output, token))
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        if ready is not None:
+            ready(server.server_address)
+        while not coordinator.done.wait(1.0):
+            pass
+        # Give polling workers a moment to hear that the run is finished.
+        sleep(min(RETRY_INTERVAL, 1.0))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _post(url, body, token, timeout=30):
+    from urllib.request import Request, urlopen
+    request = Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json', TOKEN_HEADER: token})
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _relative(relpath):
+    # Job paths come from the network: only plain relative paths are joined
+    # to the local roots.
+    return (isinstance(relpath, str) and relpath and not path.isabs(relpath) and not re.match(r'^[A-Za-z]:', relpath)
+            and '..' not in re.split(r'[\\/]', relpath))
+
+
+def _leased_settings(settings, output):
+    # settings with the coordinator's output settings in place of this
+    # host's own, so that every worker writes the audio the coordinator
+    # journals: format, input frequency and channels, and profile.
+    settings = dict(settings, frequency=output['frequency'], channels=output['channels'], profile=None)
+    if output['profile'] is not None:
+        settings.update(profile='leased', profiles={'leased': output['profile']})
+    return output['extension'][1:], settings
+
+
+def run_worker(url, source_root, destination_root, settings, token, workers=1, name=None, on_success=None,
+               on_failure=None, should_stop=None):
+    # Leases jobs from the coordinator at url, converts them between its own
+    # source and destination roots (the same trees, mounted on this host) and
+    # reports back. Returns once the coordinator is finished, or gone after
+    # having answered once.
+    url = url.rstrip('/')
+    # Workers keep no manifest, so there is nothing to hash inputs for.
+    settings = dict(settings, hash=None)
+    name = name or '{}:{}'.format(socket.gethostname(), getpid())
+    encoders = {}
+    connected = False
+    while should_stop is None or not should_stop():
+        try:
+            lease = _post(url + '/lease', {'worker': name}, token)
+        except OSError as error:
+            if getattr(error, 'code', None) == 401:
+                raise PermissionError("The coordinator at {} refused the token".format(url))
+            # URLError, refused connections and timeouts alike.
+            if connected:
+                return True
+            # The coordinator may not be listening yet.
+            sleep(RETRY_INTERVAL)
+            continue
+        connected = True
+        if lease['lease'] is None:
+            if lease['finished']:
+                return True
+            sleep(RETRY_INTERVAL)
+            continue
+        key = json.dumps(lease['output'], sort_keys=True)
+        if key not in encoders:
+            encoders[key] = get_encoder(*_leased_settings(settings, lease['output']))
+        encoder = encoders[key]
+        jobs = [JournalJob(*job) for job in lease['jobs']]
+        converted = []
+        failed = [job.source for job in jobs if not (_relative(job.source) and _relative(job.output))]
+        plan = plan_jobs(source_root, destination_root, [job for job in jobs if job.source not in failed]).largest_first()
+        plan.make_dirs()
+        resources = plan.resources()
+        sources = {resource_path: job.source for job, resource_path in zip(plan.jobs, resources)}
+        def success(resource_path, destination_path):
+            converted.append(sources[resource_path])
+            if on_success is not None:
+                on_success(resource_path, destination_path)
+        def failure(resource_path, destination_path):
+            failed.append(sources[resource_path])
+            if on_failure is not None:
+                on_failure(resource_path, destination_path)
+        convert_all(resources.items(), encoder, settings, workers, success, failure, should_stop)
+        try:
+            _post(url + '/report', {'lease': lease['lease'], 'converted': converted, 'failed': failed}, token)
+        except OSError:
+            return True
+    return False
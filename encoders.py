@@ -0,0 +1,525 @@
+from glob import escape, glob
+from os import path, remove, replace, urandom
+
+import subprocess
+
+from metrics import measure
+
+SAMPLE_WIDTH = 2
+MP3_BITRATE = 128
+MP3_QUALITY = 3
+CHUNK_SIZE = 1 << 20
+# Tells apart the partial outputs of processes writing the same file, e.g.
+# two workers holding the same job after a lease expired.
+PARTIAL_TAG = urandom(4).hex()
+
+
+def partial_path(destination_path):
+    # Outputs are written under this name and renamed once complete, so an
+    # interrupted conversion never leaves a truncated file at the final path.
+    directory, filename = path.split(destination_path)
+    return path.join(directory, '.{}.{}.part'.format(filename, PARTIAL_TAG))
+
+
+def discard_partials(destination_path):
+    # Removes the partial outputs any process left for destination_path.
+    directory, filename = path.split(destination_path)
+    for partial in glob(path.join(escape(directory), escape('.' + filename) + '.*.part')):
+        discard(partial)
+
+
+def discard(file_path):
+    try:
+        remove(file_path)
+    except OSError:
+        pass
+
+
+def startupinfo():
+    # Keeps ffmpeg from flashing a console window on Windows.
+    if not hasattr(subprocess, 'STARTUPINFO'):
+        return None
+    info = subprocess.STARTUPINFO()
+    info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return info
+
+
+def raw_format(settings):
+    # (frequency, channels) of the raw input, to check the length of
+    # existing outputs against; None when a profile trims silence, as the
+    # outputs' length is then unknown.
+    profile = (settings.get("profiles") or {}).get(settings.get("profile") or '') or {}
+    if profile.get("trim_db") is not None:
+        return None
+    return int(settings["frequency"]), int(settings["channels"])
+
+
+class EncoderStream:
+    # Incremental encoder for one output file. write() accepts s16le chunks of
+    # any size; frames split across chunks are carried over, and a trailing
+    # partial frame (truncated capture) is dropped on close(). Input without
+    # a single whole frame fails in every backend instead of giving an empty
+    # or broken file.
+
+    def __init__(self, frame_size):
+        self.frame_size = frame_size
+        self._rest = b''
+        self._empty = True
+
+    def write(self, data):
+        if self._rest:
+            data = self._rest + data
+        cut = len(data) - len(data) % self.frame_size
+        self._rest = data[cut:]
+        if cut:
+            self._empty = False
+            self._write_frames(data if cut == len(data) else data[:cut])
+
+    def close(self):
+        self._rest = b''
+        if self._empty:
+            self.abort()
+            return False
+        return self._finish()
+
+    def abort(self):
+        pass
+
+    def _write_frames(self, frames):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+
+class Encoder:
+    # Turns s16le input into audio_format. Subclasses implement open_stream();
+    # convert() feeds the input file to it in CHUNK_SIZE pieces, so memory use
+    # does not depend on the size of the capture. Staged encoders accept a
+    # file object as well as a path in open_stream(), so that reading,
+    # encoding and writing can run in separate threads (pipeline.py). With a
+    # preprocessing profile (preprocess.py) frequency and channels are those
+    # of the output, and open_input() puts the profile in front of the stream.
+    name = None
+    formats = ()
+    staged = False
+
+    def __init__(self, audio_format, settings):
+        self.audio_format = audio_format
+        self.frequency = int(settings["frequency"])
+        self.channels = int(settings["channels"])
+        # With "hash" set, inputs are hashed while they are read for encoding;
+        # the digests of converted files wait in self.digests for the manifest.
+        self.hash_name = settings.get("hash")
+        self.digests = {}
+        self.preprocessor = None
+        if settings.get("profile"):
+            # numpy is only imported when a profile is used.
+            from preprocess import preprocessor_for
+            self.preprocessor = preprocessor_for(settings)
+            self.frequency = self.preprocessor.frequency
+            self.channels = self.preprocessor.channels
+        self.frame_size = SAMPLE_WIDTH * self.channels
+        self.batch_size = 1
+
+    @classmethod
+    def available(cls, audio_format=None):
+        # Whether the encoder can run here, for audio_format or any of formats.
+        return True
+
+    def open_stream(self, destination_path):
+        raise NotImplementedError
+
+    def open_input(self, destination_path, resource_path=None):
+        # The stream raw input is written to. Normalising and trimming profiles
+        # look at the whole input first, so they need resource_path.
+        stream = self.open_stream(destination_path)
+        if self.preprocessor is None:
+            return stream
+        try:
+            return self.preprocessor.open(stream, resource_path)
+        except BaseException:
+            stream.abort()
+            raise
+
+    def new_digest(self):
+        if not self.hash_name:
+            return None
+        from manifest import new_hash
+        return new_hash(self.hash_name)
+
+    def keep_digest(self, resource_path, digest):
+        if digest is not None:
+            from manifest import format_digest
+            self.digests[resource_path] = format_digest(digest)
+
+    def _atomic(self, destination_path, write):
+        # write(path) produces the output under its partial name; it is moved
+        # into place only when write reports success.
+        writing_path = partial_path(destination_path)
+        try:
+            converted = write(writing_path)
+        except BaseException:
+            discard(writing_path)
+            raise
+        if converted:
+            with measure('write'):
+                replace(writing_path, destination_path)
+        else:
+            discard(writing_path)
+        return converted
+
+    def _stream(self, chunks, destination_path, resource_path=None):
+        stream = self.open_input(destination_path, resource_path)
+        try:
+            for chunk in chunks:
+                stream.write(chunk)
+        except BaseException:
+            stream.abort()
+            raise
+        return stream.close()
+
+    def encode_chunks(self, chunks, destination_path):
+        return self._atomic(destination_path, lambda writing_path: self._stream(chunks, writing_path))
+
+    def encode(self, data, destination_path):
+        return self.encode_chunks([data], destination_path)
+
+    def _convert(self, resource_path, destination_path):
+        digest = self.new_digest()
+        with open(resource_path, 'rb') as resource:
+            converted = self._stream(self._read_chunks(resource, digest), destination_path, resource_path)
+        if converted:
+            self.keep_digest(resource_path, digest)
+        return converted
+
+    def convert(self, resource_path, destination_path):
+        return self._atomic(destination_path, lambda writing_path: self._convert(resource_path, writing_path))
+
+    def _read_chunks(self, resource, digest=None):
+        while True:
+            with measure('read'):
+                chunk = resource.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            if digest is not None:
+                digest[1].update(chunk)
+            yield chunk
+
+    def convert_batch(self, jobs):
+        return [self.convert(*job) for job in jobs]
+
+
+class FfmpegStream(EncoderStream):
+
+    def __init__(self, frame_size, command):
+        EncoderStream.__init__(self, frame_size)
+        # Output is discarded rather than piped: nobody reads the pipes while
+        # chunks are written, and a full stderr pipe would stall ffmpeg.
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, startupinfo=startupinfo())
+
+    def _write_frames(self, frames):
+        self.process.stdin.write(frames)
+
+    def _finish(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self.process.wait() == 0
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class FfmpegEncoder(Encoder):
+    name = 'ffmpeg'
+    formats = ('flac', 'mp3')
+    # The ffmpeg encoder each format needs: builds without libmp3lame are common.
+    codecs = {'flac': 'flac', 'mp3': 'libmp3lame'}
+
+    def __init__(self, audio_format, settings):
+        Encoder.__init__(self, audio_format, settings)
+        self.batch_size = max(1, int(settings.get("batch_size", 1)))
+
+    @classmethod
+    def available(cls, audio_format=None):
+        from ffmpeg_probe import probe_ffmpeg
+        info = probe_ffmpeg()
+        if info is None:
+            return False
+        formats = cls.formats if audio_format is None else (audio_format,)
+        return any(cls.codecs.get(name) in info['encoders'] for name in formats)
+
+    def _input(self, resource_path):
+        return [
+            "-f",
+            "s16le",
+            "-ar",
+            str(self.frequency),
+            "-ac",
+            str(self.channels),
+            "-i",
+            resource_path
+        ]
+
+    def _output(self, destination_path):
+        # The muxer is named explicitly: partial output names have no usable
+        # extension for ffmpeg to guess it from.
+        return ["-f", self.audio_format, destination_path]
+
+    def _command(self, resource_path, destination_path):
+        return ["ffmpeg", "-y"] + self._input(resource_path) + self._output(destination_path)
+
+    def _run(self, command):
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo())
+        p.communicate()
+        return p.returncode == 0
+
+    def open_stream(self, destination_path):
+        return FfmpegStream(self.frame_size, self._command("pipe:0", destination_path))
+
+    def _whole(self, resource_path):
+        # Whether the input holds a frame: ffmpeg reading it directly would
+        # encode an empty input as a valid, silent file.
+        return path.getsize(resource_path) >= self.frame_size
+
+    def _convert(self, resource_path, destination_path):
+        # ffmpeg reads the file itself, which streams it already; preprocessed
+        # or hashed input is piped to it instead.
+        if self.preprocessor is not None or self.hash_name:
+            return Encoder._convert(self, resource_path, destination_path)
+        return self._whole(resource_path) and self._run(self._command(resource_path, destination_path))
+
+    def convert_batch(self, jobs):
+        # One ffmpeg process for the whole batch: every input gets its own -i
+        # and is mapped to its own output. ffmpeg gives up on the whole batch
+        # if a single input is broken, so on failure every file is retried
+        # alone to find out which ones actually fail.
+        if len(jobs) == 1 or self.preprocessor is not None or self.hash_name:
+            return Encoder.convert_batch(self, jobs)
+        if not all(self._whole(resource_path) for resource_path, _ in jobs):
+            return Encoder.convert_batch(self, jobs)
+        command = ["ffmpeg", "-y"]
+        for resource_path, _ in jobs:
+            command += self._input(resource_path)
+        for index, (_, destination_path) in enumerate(jobs):
+            command += ["-map", "{}:a".format(index)] + self._output(partial_path(destination_path))
+        try:
+            converted = self._run(command)
+        except BaseException:
+            for _, destination_path in jobs:
+                discard(partial_path(destination_path))
+            raise
+        for _, destination_path in jobs:
+            if converted:
+                replace(partial_path(destination_path), destination_path)
+            else:
+                discard(partial_path(destination_path))
+        if converted:
+            return [True] * len(jobs)
+        return Encoder.convert_batch(self, jobs)
+
+
+class TimedOutput:
+    # Output file handed to libsndfile, which writes it itself from inside
+    # the encode: its writes are measured here so that they count as write
+    # time rather than encode time.
+
+    def __init__(self, destination):
+        self.destination = destination
+
+    def write(self, data):
+        with measure('write'):
+            return self.destination.write(data)
+
+    def seek(self, offset, whence=0):
+        return self.destination.seek(offset, whence)
+
+    def tell(self):
+        return self.destination.tell()
+
+    def read(self, size=-1):
+        return self.destination.read(size)
+
+    def close(self):
+        with measure('write'):
+            self.destination.close()
+
+
+class SoundfileStream(EncoderStream):
+
+    def __init__(self, frame_size, sound_file, destination):
+        EncoderStream.__init__(self, frame_size)
+        self.sound_file = sound_file
+        self.destination = destination
+
+    def _write_frames(self, frames):
+        self.sound_file.buffer_write(frames, dtype='int16')
+
+    def _finish(self):
+        # libsndfile patches the header on close but leaves the file object
+        # open.
+        self.sound_file.close()
+        self.destination.close()
+        return True
+
+    def abort(self):
+        self.sound_file.close()
+        self.destination.close()
+
+
+class SoundfileEncoder(Encoder):
+    name = 'soundfile'
+    formats = ('flac',)
+    staged = True
+
+    @classmethod
+    def available(cls, audio_format=None):
+        try:
+            import soundfile
+        except (ImportError, OSError):
+            return False
+        return True
+
+    def open_stream(self, destination_path):
+        import soundfile
+        if isinstance(destination_path, str):
+            destination = TimedOutput(open(destination_path, 'w+b'))
+        else:
+            destination = destination_path
+        try:
+            sound_file = soundfile.SoundFile(destination, 'w', self.frequency, self.channels, 'PCM_16',
+                                             format='FLAC')
+        except BaseException:
+            destination.close()
+            raise
+        return SoundfileStream(self.frame_size, sound_file, destination)
+
+
+class LameStream(EncoderStream):
+
+    def __init__(self, frame_size, encoder, destination):
+        EncoderStream.__init__(self, frame_size)
+        self.encoder = encoder
+        self.destination = destination
+
+    def _write_frames(self, frames):
+        encoded = self.encoder.encode(frames)
+        with measure('write'):
+            self.destination.write(encoded)
+
+    def _finish(self):
+        encoded = self.encoder.flush()
+        with measure('write'):
+            with self.destination:
+                self.destination.write(encoded)
+        return True
+
+    def abort(self):
+        self.destination.close()
+
+
+class LameEncoder(Encoder):
+    name = 'lameenc'
+    formats = ('mp3',)
+    staged = True
+
+    @classmethod
+    def available(cls, audio_format=None):
+        try:
+            import lameenc
+        except ImportError:
+            return False
+        return True
+
+    def open_stream(self, destination_path):
+        import lameenc
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(MP3_BITRATE)
+        encoder.set_in_sample_rate(self.frequency)
+        encoder.set_channels(self.channels)
+        encoder.set_quality(MP3_QUALITY)
+        destination = open(destination_path, 'wb') if isinstance(destination_path, str) else destination_path
+        return LameStream(self.frame_size, encoder, destination)
+
+
+class FanoutEncoder(Encoder):
+    # Encodes one read of the raw input into several outputs. convert() takes
+    # a tuple with a destination per encoder, None for outputs that are up to
+    # date. Outputs are moved into place as they succeed; the job counts as
+    # converted only when every one of them did. The outputs of a failed job
+    # that did succeed wait in self.written for the manifests. Streams are fed
+    # from the converting thread, so it always runs on the plain pool.
+    name = 'fanout'
+
+    def __init__(self, encoders):
+        self.encoders = encoders
+        self.audio_format = ','.join(encoder.audio_format for encoder in encoders)
+        self.batch_size = 1
+        self.hash_name = encoders[0].hash_name
+        self.digests = {}
+        self.written = {}
+
+    def convert(self, resource_path, destination_paths):
+        outputs = [(encoder, destination_path, partial_path(destination_path))
+                   for encoder, destination_path in zip(self.encoders, destination_paths) if destination_path is not None]
+        streams = []
+        digest = self.new_digest()
+        try:
+            for encoder, _, writing_path in outputs:
+                streams.append(encoder.open_input(writing_path, resource_path))
+            with open(resource_path, 'rb') as resource:
+                for chunk in self._read_chunks(resource, digest):
+                    for stream in streams:
+                        stream.write(chunk)
+        except BaseException:
+            for stream in streams:
+                try:
+                    stream.abort()
+                except Exception:
+                    pass
+            for _, _, writing_path in outputs:
+                discard(writing_path)
+            raise
+        written = []
+        for (_, destination_path, writing_path), stream in zip(outputs, streams):
+            try:
+                closed = stream.close()
+            except Exception:
+                closed = False
+            if closed:
+                with measure('write'):
+                    replace(writing_path, destination_path)
+                written.append(destination_path)
+            else:
+                discard(writing_path)
+        if written:
+            self.keep_digest(resource_path, digest)
+        if len(written) == len(outputs):
+            return True
+        if written:
+            self.written[resource_path] = written
+        return False
+
+
+ENCODERS = [SoundfileEncoder, LameEncoder, FfmpegEncoder]
+NATIVE_ENCODERS = [encoder for encoder in ENCODERS if encoder is not FfmpegEncoder]
+
+
+def get_encoder(audio_format, settings, backend=None):
+    # backend is "auto" (in-process when possible, ffmpeg otherwise),
+    # "native", "ffmpeg" or the name of a specific encoder.
+    backend = backend or settings.get("encoder", "auto")
+    if backend == "auto":
+        candidates = ENCODERS
+    elif backend == "native":
+        candidates = NATIVE_ENCODERS
+    else:
+        candidates = [encoder for encoder in ENCODERS if encoder.name == backend]
+    for encoder in candidates:
+        if audio_format in encoder.formats and encoder.available(audio_format):
+            return encoder(audio_format, settings)
+    raise ValueError("No {} encoder available for {}".format(backend, audio_format))
@@ -0,0 +1,93 @@
+from os import path, environ, makedirs, replace, stat
+from shutil import which
+from threading import Lock
+
+import json
+import subprocess
+
+CACHE_NAME = 'ffmpeg_probe.json'
+
+_probed = {}
+_lock = Lock()
+
+
+def cache_path():
+    # Per-user cache: %LOCALAPPDATA%\raw2flac on Windows, $XDG_CACHE_HOME (or
+    # ~/.cache)/raw2flac elsewhere.
+    root = environ.get('LOCALAPPDATA') or environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+    return path.join(root, 'raw2flac', CACHE_NAME)
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as cached:
+            return json.load(cached)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache_file, entries):
+    try:
+        makedirs(path.dirname(cache_file), exist_ok=True)
+        temporary_path = cache_file + '.tmp'
+        with open(temporary_path, 'w') as temporary:
+            json.dump(entries, temporary, indent=2)
+        replace(temporary_path, cache_file)
+    except OSError:
+        pass
+
+
+def _run(binary, *args):
+    from encoders import startupinfo
+    p = subprocess.Popen([binary, '-hide_banner'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         startupinfo=startupinfo())
+    out, _ = p.communicate()
+    return out.decode('utf-8', 'replace')
+
+
+def _probe(binary):
+    lines = _run(binary, '-version').splitlines()
+    version = lines[0] if lines else ''
+    encoders = []
+    listed = False
+    for line in _run(binary, '-encoders').splitlines():
+        # A legend, a " ------" line, then one line per encoder:
+        # " A....D flac                 FLAC (Free Lossless Audio Codec)"
+        fields = line.split()
+        if fields == ['------']:
+            listed = True
+        elif listed and len(fields) >= 2 and fields[0].startswith('A'):
+            encoders.append(fields[1])
+    return {'version': version, 'encoders': encoders}
+
+
+def probe_ffmpeg(binary='ffmpeg', cache_file=None):
+    # Returns {'path', 'version', 'encoders'} for the ffmpeg on PATH, or None
+    # when there is none. ffmpeg is only run when the binary is new or was
+    # replaced: results are cached on disk by its path and mtime, and in
+    # memory for the life of the process.
+    found = which(binary)
+    if found is None:
+        return None
+    found = path.realpath(found)
+    try:
+        mtime_ns = stat(found).st_mtime_ns
+    except OSError:
+        return None
+    with _lock:
+        info = _probed.get(found)
+        if info is not None and info['mtime_ns'] == mtime_ns:
+            return info
+        cache_file = cache_file or cache_path()
+        entries = _read_cache(cache_file)
+        info = entries.get(found)
+        if info is None or info.get('mtime_ns') != mtime_ns:
+            try:
+                info = dict(_probe(found), path=found, mtime_ns=mtime_ns)
+            except OSError:
+                return None
+            entries[found] = info
+            _write_cache(cache_file, entries)
+        _probed[found] = info
+        return info
+
@@ -0,0 +1,137 @@
+from collections import namedtuple
+from os import path, makedirs, remove, fsync, truncate
+from threading import Lock
+
+import json
+
+from encoders import discard_partials
+
+JOURNAL_NAME = '.raw2flac_journal'
+
+JournalJob = namedtuple('JournalJob', ['source', 'output', 'size', 'mtime_ns', 'digest'])
+
+
+class Resume(namedtuple('Resume', ['source_root', 'output', 'pending', 'done', 'in_flight'])):
+    __slots__ = ()
+
+    def matches(self, source_root, output):
+        # Only a run converting the same tree into the same kind of output
+        # may finish the jobs: the journaled output paths carry the extension.
+        return self.source_root == path.realpath(source_root) and self.output == output
+
+
+def output_settings(extension, settings):
+    # Everything in a run's settings that changes what its outputs contain.
+    # Journaled with the plan; it goes through JSON, hence the plain types.
+    profile = settings.get("profile") or None
+    return {'extension': extension, 'frequency': int(settings["frequency"]), 'channels': int(settings["channels"]),
+            'profile': (settings.get("profiles") or {}).get(profile) if profile else None}
+
+
+class Journal:
+    # Append-only JSON lines log of one conversion run, kept in the
+    # destination tree: the planned jobs first, then a line whenever a job
+    # starts, is done or fails. It is removed once the run completes, so a
+    # journal left on disk means the previous run was interrupted.
+
+    def __init__(self, destination_root):
+        self.destination_root = destination_root
+        self.path = path.join(destination_root, JOURNAL_NAME)
+        self._file = None
+        self._lock = Lock()
+
+    def exists(self):
+        return path.isfile(self.path)
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def plan(self, source_root, jobs, output=None):
+        # output is the run's output_settings(), checked before resuming.
+        makedirs(self.destination_root, exist_ok=True)
+        self.close()
+        self._file = open(self.path, 'w')
+        self._write({'source_root': path.realpath(source_root), 'output': output})
+        with self._lock:
+            for job in jobs:
+                self._file.write(json.dumps({'plan': list(job)}) + '\n')
+        self.sync()
+
+    def reopen(self):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+
+    def started(self, source):
+        self._write({'start': source})
+
+    def done(self, source):
+        self._write({'done': source})
+
+    def failed(self, source):
+        self._write({'failed': source})
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def complete(self):
+        self.close()
+        if self.exists():
+            remove(self.path)
+
+    def resume(self, read_only=False):
+        # Returns what an interrupted run still has to do, or None. Jobs that
+        # were in flight are converted again; their partial outputs are
+        # removed here. A torn last line (crash mid-write) is ignored. With
+        # read_only (dry runs) the journal and partial outputs are left as
+        # they are.
+        if not self.exists():
+            return None
+        source_root = None
+        output = None
+        planned = {}
+        started = set()
+        finished = set()
+        done = []
+        valid = 0
+        with open(self.path, 'rb') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                valid += len(line)
+                if 'source_root' in entry:
+                    source_root = entry['source_root']
+                    output = entry.get('output')
+                elif 'plan' in entry:
+                    job = JournalJob(*entry['plan'])
+                    planned[job.source] = job
+                elif 'start' in entry:
+                    started.add(entry['start'])
+                elif 'done' in entry and entry['done'] in planned:
+                    finished.add(entry['done'])
+                    done.append(planned[entry['done']])
+                elif 'failed' in entry:
+                    finished.add(entry['failed'])
+        if valid < path.getsize(self.path) and not read_only:
+            # Drop the torn line so that entries appended on resume parse.
+            truncate(self.path, valid)
+        pending = [job for source, job in planned.items() if source not in finished]
+        in_flight = [job for job in pending if job.source in started]
+        if not read_only:
+            for job in in_flight:
+                discard_partials(path.join(self.destination_root, job.output))
+        return Resume(source_root, output, pending, done, in_flight)
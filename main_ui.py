@@ -38,6 +38,9 @@ class Ui_Form(object):
         self.audioFormatComboBox.addItem("")
         self.audioFormatComboBox.addItem("")
         self.gridLayout.addWidget(self.audioFormatComboBox, 3, 2, 1, 1)
+        self.alsoFormatsCheckBox = QtWidgets.QCheckBox(Form)
+        self.alsoFormatsCheckBox.setObjectName("alsoFormatsCheckBox")
+        self.gridLayout.addWidget(self.alsoFormatsCheckBox, 4, 2, 1, 1)
         self.destinationDirectoryDialogButton = QtWidgets.QToolButton(Form)
         self.destinationDirectoryDialogButton.setObjectName("destinationDirectoryDialogButton")
         self.gridLayout.addWidget(self.destinationDirectoryDialogButton, 2, 3, 1, 1)
@@ -107,6 +110,8 @@ class Ui_Form(object):
         self.audioFormatLabel.setText(_translate("Form", "Audio Format"))
         self.audioFormatComboBox.setItemText(0, _translate("Form", "mp3"))
         self.audioFormatComboBox.setItemText(1, _translate("Form", "flac"))
+        self.alsoFormatsCheckBox.setToolTip(_translate("Form", "Read every raw file once and also convert it to the other formats, each into <Resource Directory>_<format>"))
+        self.alsoFormatsCheckBox.setText(_translate("Form", "Also convert to the other formats"))
         self.destinationDirectoryDialogButton.setText(_translate("Form", "..."))
         self.destinationDirectoryLabel.setText(_translate("Form", "Destination Directory"))
         self.resourceDirectoryLineEdit.setPlaceholderText(_translate("Form", "Path to raw audio"))
@@ -0,0 +1,249 @@
+from collections import namedtuple
+from os import path, makedirs
+from threading import Lock
+
+import hashlib
+import sqlite3
+
+from encoders import SAMPLE_WIDTH
+from tree_diff import TreeDiff, TreeIndex, scan_tree
+
+MANIFEST_NAME = '.raw2flac_manifest.sqlite'
+COMMIT_EVERY = 100
+HASH_CHUNK_SIZE = 1 << 20
+# Seconds an adopted output may differ from its raw input: mp3 pads both
+# ends by up to a couple of frames.
+DURATION_TOLERANCE = 0.25
+
+Record = namedtuple('Record', ['size', 'mtime_ns', 'output', 'digest', 'output_size'])
+
+
+def new_hash(hash_name):
+    # (name, hash object). "xxhash" is used when the package is installed,
+    # BLAKE2 otherwise. The name is part of a digest (format_digest) so that
+    # digests of different kinds never match.
+    if hash_name == 'xxhash':
+        try:
+            import xxhash
+            return hash_name, xxhash.xxh3_64()
+        except ImportError:
+            pass
+    return 'blake2b', hashlib.blake2b(digest_size=16)
+
+
+def format_digest(digest):
+    hash_name, hasher = digest
+    return hash_name + ':' + hasher.hexdigest()
+
+
+def file_digest(filepath, hash_name):
+    digest = new_hash(hash_name)
+    with open(filepath, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            digest[1].update(chunk)
+    return format_digest(digest)
+
+
+class Manifest:
+    # Record of every file converted into a destination tree, stored next to
+    # the outputs. Paths are relative to the source and destination roots.
+    # A read_only manifest (dry runs) works on an in-memory copy: it plans
+    # like the real one, but nothing is written to the destination.
+
+    def __init__(self, destination_root, read_only=False):
+        self.destination_root = destination_root
+        self.read_only = read_only
+        self.path = path.join(destination_root, MANIFEST_NAME)
+        self._connection = None
+        self._pending = 0
+        self._lock = Lock()
+
+    def exists(self):
+        return path.isfile(self.path)
+
+    def _connect(self):
+        if self._connection is None:
+            if self.read_only:
+                self._connection = sqlite3.connect(':memory:', check_same_thread=False)
+                if self.exists():
+                    from urllib.request import pathname2url
+                    stored = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(path.abspath(self.path))), uri=True)
+                    try:
+                        stored.backup(self._connection)
+                    finally:
+                        stored.close()
+            else:
+                makedirs(self.destination_root, exist_ok=True)
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                source TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                output TEXT NOT NULL,
+                digest TEXT,
+                output_size INTEGER,
+                PRIMARY KEY (source, output))""")
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(files)")}
+            for column, kind in (('digest', 'TEXT'), ('output_size', 'INTEGER')):
+                if column not in columns:
+                    self._connection.execute("ALTER TABLE files ADD COLUMN {} {}".format(column, kind))
+        return self._connection
+
+    def _changed(self, connection):
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            connection.commit()
+            self._pending = 0
+
+    def records(self, extension):
+        if self._connection is None and not self.exists():
+            return {}
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT source, size, mtime_ns, output, digest, output_size FROM files WHERE output LIKE ?",
+                ('%' + extension,)).fetchall()
+        return {row[0]: Record(*row[1:]) for row in rows}
+
+    def record(self, source, size, mtime_ns, output, digest=None):
+        output_path = path.join(self.destination_root, output)
+        output_size = path.getsize(output_path) if path.isfile(output_path) else None
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM files WHERE source = ? AND output LIKE ?",
+                               (source, '%' + path.splitext(output)[1]))
+            connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                               (source, size, mtime_ns, output, digest, output_size))
+            self._changed(connection)
+
+    def update_stat(self, source, output, size, mtime_ns):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE source = ? AND output = ?",
+                               (size, mtime_ns, source, output))
+            self._changed(connection)
+
+    def remove(self, outputs):
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("DELETE FROM files WHERE output = ?", [(output,) for output in outputs])
+            self._changed(connection)
+
+    def flush(self):
+        with self._lock:
+            if self._connection is not None and self._pending:
+                self._connection.commit()
+                self._pending = 0
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def _complete(output_path, size, input_format):
+    # Whether the output holds as much audio as the raw input of size bytes
+    # in input_format (frequency, channels), and its end can be read: a
+    # header written up front may promise more than a cut short file has.
+    # Outputs get the benefit of the doubt only when they can't be checked
+    # here (no soundfile, or a format libsndfile doesn't read); one that
+    # fails to open is damaged.
+    try:
+        import soundfile
+    except (ImportError, OSError):
+        return True
+    if path.splitext(output_path)[1][1:].upper() not in soundfile.available_formats():
+        return True
+    try:
+        output = soundfile.SoundFile(output_path)
+    except (OSError, RuntimeError):
+        return False
+    frequency, channels = input_format
+    with output:
+        duration = output.frames / output.samplerate if output.samplerate else 0.0
+        if abs(duration - size / (SAMPLE_WIDTH * channels * frequency)) > DURATION_TOLERANCE:
+            return False
+        if not output.frames:
+            return True
+        try:
+            output.seek(max(0, output.frames - int(DURATION_TOLERANCE * output.samplerate)))
+            return len(output.read(1)) > 0
+        except RuntimeError:
+            return False
+
+
+def repair_manifest(source_root, destination_root, extension, manifest=None, source=None, input_format=None):
+    # Bring the manifest in line with the disk: forget outputs that no longer
+    # exist or whose size changed since they were recorded (truncated or half
+    # written), and adopt non-empty outputs that were never recorded, unless
+    # they are older than their source (made from an earlier capture) or,
+    # with input_format (encoders.raw_format), decode to a different length
+    # than the source (cut short). Returns the number of (added, removed)
+    # records.
+    manifest = manifest or Manifest(destination_root)
+    source = source or scan_tree(source_root, stat=True)
+    destination = scan_tree(destination_root, extension, stat=True).stats
+    records = manifest.records(extension)
+    removed = []
+    for record in records.values():
+        output_stat = destination.get(record.output)
+        if output_stat is None or record.output_size not in (None, output_stat[0]):
+            removed.append(record.output)
+    manifest.remove(removed)
+    removed = set(removed)
+    added = 0
+    for relpath in source.files:
+        output = relpath + extension
+        output_stat = destination.get(output)
+        if (relpath in records and records[relpath].output not in removed) or output_stat is None or output_stat[0] <= 0:
+            continue
+        size, mtime_ns = source.stats[relpath]
+        if output_stat[1] < mtime_ns:
+            continue
+        if input_format is not None and not _complete(path.join(destination_root, output), size, input_format):
+            continue
+        manifest.record(relpath, size, mtime_ns, output)
+        added += 1
+    manifest.flush()
+    return added, len(removed)
+
+
+def diff_manifest(source_root, destination_root, extension, manifest=None, hash_name=None, source=None,
+                  input_format=None, hashed=None):
+    # Same result as tree_diff.diff_trees, but the destination side comes from
+    # the manifest, so only the source tree is walked. A source file is new
+    # when it has no record or its size/mtime differ from the recorded ones.
+    # With hash_name set, a recorded file whose size/mtime changed but whose
+    # content hash still matches is not reconverted; the digests of the other
+    # changed files are returned so they can be recorded once converted.
+    # Files without a record are not hashed here: the encoders hash them as
+    # they read them (Encoder.digests). source
+    # is a scan_tree(source_root, stat=True) index to reuse, if there is one;
+    # input_format is passed to repair_manifest. hashed maps relpaths to the
+    # digests already computed against other manifests of the same scan.
+    manifest = manifest or Manifest(destination_root)
+    source = source or scan_tree(source_root, stat=True)
+    if not manifest.exists():
+        repair_manifest(source_root, destination_root, extension, manifest, source, input_format)
+    records = manifest.records(extension)
+    new_files = []
+    digests = {}
+    hashed = {} if hashed is None else hashed
+    for relpath in source.files:
+        stat = source.stats[relpath]
+        record = records.get(relpath)
+        if record is not None and (record.size, record.mtime_ns) == stat:
+            continue
+        if hash_name and record is not None:
+            digest = hashed.get(relpath)
+            if digest is None:
+                digest = hashed[relpath] = file_digest(path.join(source_root, relpath), hash_name)
+            if record.digest == digest:
+                manifest.update_stat(relpath, record.output, *stat)
+                continue
+            digests[relpath] = digest
+        new_files.append(relpath)
+    manifest.flush()
+    converted = [record.output for record in records.values()]
+    return TreeDiff(source, TreeIndex([], converted), new_files, digests)
@@ -0,0 +1,184 @@
+from collections import deque
+from contextlib import contextmanager
+from os import path, replace
+from threading import Lock, local
+from time import perf_counter
+
+import json
+
+STAGES = ('queue_wait', 'read', 'encode', 'write', 'total')
+QUANTILES = (0.5, 0.95, 0.99)
+# Files the live figures (RunMetrics.live) take their per-file quantile from.
+RECENT_FILES = 1000
+
+_current = local()
+
+
+@contextmanager
+def measure(stage):
+    # Adds the time spent in the block to the current thread's conversion,
+    # if one is being measured; a no-op otherwise.
+    timings = getattr(_current, 'timings', None)
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + perf_counter() - start
+
+
+def begin_measure():
+    _current.timings = {}
+    return _current.timings
+
+
+def end_measure():
+    _current.timings = None
+
+
+class FileMetrics:
+    # Read and write only cover what the encoder does in-process; whatever
+    # else the conversion took (encoding, ffmpeg start-up) counts as encode.
+    __slots__ = ('source', 'destination', 'converted', 'queue_wait', 'read', 'encode', 'write',
+                 'total', 'input_bytes', 'output_bytes')
+
+    def __init__(self, source, destination, converted, queue_wait, total, timings, input_bytes, output_bytes):
+        self.source = source
+        self.destination = destination
+        self.converted = converted
+        self.queue_wait = queue_wait
+        self.total = total
+        self.read = timings.get('read', 0.0)
+        self.write = timings.get('write', 0.0)
+        self.encode = max(0.0, total - self.read - self.write)
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+
+    @property
+    def compression_ratio(self):
+        return self.input_bytes / self.output_bytes if self.output_bytes else 0.0
+
+    def as_dict(self):
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields['compression_ratio'] = self.compression_ratio
+        return fields
+
+
+def percentile(values, quantile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = quantile * (len(values) - 1)
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+class RunMetrics:
+    # Collects FileMetrics for a whole run; safe to read while it is filled.
+    # summary() sorts every file's timings, which takes a while on large
+    # runs; live() keeps to running totals and the latest files, for
+    # progress shown while converting.
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.finished = None
+        self.files = []
+        self._converted = 0
+        self._input_bytes = 0
+        self._recent = deque(maxlen=RECENT_FILES)
+        self._lock = Lock()
+
+    def add(self, file_metrics):
+        with self._lock:
+            self.files.append(file_metrics)
+            if file_metrics.converted:
+                self._converted += 1
+                self._input_bytes += file_metrics.input_bytes
+                self._recent.append(file_metrics.total)
+
+    def finish(self):
+        self.finished = perf_counter()
+
+    def live(self):
+        with self._lock:
+            converted, input_bytes, recent = self._converted, self._input_bytes, list(self._recent)
+        elapsed = (self.finished or perf_counter()) - self.started
+        return {
+            'converted': converted,
+            'files_per_second': converted / elapsed if elapsed else 0.0,
+            'mb_per_second': input_bytes / 2 ** 20 / elapsed if elapsed else 0.0,
+            'recent_p95': percentile(recent, 0.95),
+        }
+
+    def summary(self):
+        with self._lock:
+            files = list(self.files)
+        elapsed = (self.finished or perf_counter()) - self.started
+        converted = [metrics for metrics in files if metrics.converted]
+        input_bytes = sum(metrics.input_bytes for metrics in converted)
+        output_bytes = sum(metrics.output_bytes for metrics in converted)
+        return {
+            'elapsed': elapsed,
+            'converted': len(converted),
+            'failed': len(files) - len(converted),
+            'input_bytes': input_bytes,
+            'output_bytes': output_bytes,
+            'compression_ratio': input_bytes / output_bytes if output_bytes else 0.0,
+            'files_per_second': len(converted) / elapsed if elapsed else 0.0,
+            'mb_per_second': input_bytes / 2 ** 20 / elapsed if elapsed else 0.0,
+            'seconds': {stage: {'p{}'.format(int(quantile * 100)): percentile([getattr(metrics, stage) for metrics in converted], quantile)
+                                for quantile in QUANTILES}
+                        for stage in STAGES}
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ["{converted} files converted, {failed} failed in {elapsed:.1f}s: "
+                 "{files_per_second:.1f} files/s, {mb_per_second:.2f} MB/s, "
+                 "compression {compression_ratio:.2f}:1".format(**summary)]
+        for stage in STAGES:
+            lines.append("\t{:<10} p50 {p50:.4f}s  p95 {p95:.4f}s  p99 {p99:.4f}s".format(stage, **summary['seconds'][stage]))
+        return '\n'.join(lines)
+
+    def write_json(self, json_path):
+        with self._lock:
+            files = [metrics.as_dict() for metrics in self.files]
+        _write_atomic(json_path, json.dumps({'summary': self.summary(), 'files': files}, indent=2))
+
+    def write_prometheus(self, textfile_path):
+        # Textfile collector format; written atomically so node_exporter never
+        # reads a half-written file.
+        summary = self.summary()
+        lines = [
+            "# HELP raw2flac_files_total Files processed by the last run.",
+            "# TYPE raw2flac_files_total gauge",
+            'raw2flac_files_total{{status="converted"}} {}'.format(summary['converted']),
+            'raw2flac_files_total{{status="failed"}} {}'.format(summary['failed']),
+            "# HELP raw2flac_bytes_total Bytes read and written by the last run.",
+            "# TYPE raw2flac_bytes_total gauge",
+            'raw2flac_bytes_total{{direction="input"}} {}'.format(summary['input_bytes']),
+            'raw2flac_bytes_total{{direction="output"}} {}'.format(summary['output_bytes']),
+            "# HELP raw2flac_files_per_second Conversion throughput of the last run.",
+            "# TYPE raw2flac_files_per_second gauge",
+            "raw2flac_files_per_second {}".format(summary['files_per_second']),
+            "# HELP raw2flac_megabytes_per_second Input throughput of the last run.",
+            "# TYPE raw2flac_megabytes_per_second gauge",
+            "raw2flac_megabytes_per_second {}".format(summary['mb_per_second']),
+            "# HELP raw2flac_file_seconds Per-file time spent in each conversion stage.",
+            "# TYPE raw2flac_file_seconds gauge",
+        ]
+        for stage in STAGES:
+            for quantile in QUANTILES:
+                lines.append('raw2flac_file_seconds{{stage="{}",quantile="{}"}} {}'.format(
+                    stage, quantile, summary['seconds'][stage]['p{}'.format(int(quantile * 100))]))
+        _write_atomic(textfile_path, '\n'.join(lines) + '\n')
+
+
+def _write_atomic(file_path, text):
+    temporary_path = path.join(path.dirname(file_path) or '.', '.' + path.basename(file_path) + '.tmp')
+    with open(temporary_path, 'w') as temporary:
+        temporary.write(text)
+    replace(temporary_path, file_path)
@@ -0,0 +1,411 @@
+from collections import deque
+from os import replace
+from queue import Queue, Empty
+from threading import Lock, Event, Semaphore, Thread
+from time import perf_counter, sleep
+
+from converter import convert_files, default_workers, _size
+from encoders import CHUNK_SIZE, partial_path, discard
+from metrics import FileMetrics
+
+READERS = 2
+WRITERS = 2
+# Chunks read ahead, or encoded writes waiting, per file.
+QUEUE_CHUNKS = 4
+POLL_INTERVAL = 0.1
+
+
+class Throttle:
+    # Token bucket shared by every reader and writer: at most
+    # bytes_per_second on average, with bursts of one second.
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.tokens = self.rate
+        self.updated = perf_counter()
+        self._lock = Lock()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = perf_counter()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - nbytes
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+def throttle_for(settings):
+    # "io_limit" in config.json is in MB/s; 0 or missing means unthrottled.
+    limit = float(settings.get("io_limit") or 0)
+    return Throttle(limit * 2 ** 20) if limit > 0 else None
+
+
+class StagedOutput:
+    # File object handed to an encoder stream instead of the output file.
+    # Writes become sink(offset, data) calls for the write stage; seek() and
+    # tell() only move the position, which is all libsndfile needs to patch
+    # the FLAC header on close. Contiguous writes are gathered into pieces of
+    # CHUNK_SIZE, as encoders tend to write a few kilobytes at a time. The end
+    # of the file is signalled by the encode stage once the stream reported
+    # its result, not by close().
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.position = 0
+        self.size = 0
+        self.closed = False
+        self._offset = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        if self.position != self._offset + len(self._buffer):
+            self.flush()
+            self._offset = self.position
+        self._buffer += data
+        self.position += len(data)
+        self.size = max(self.size, self.position)
+        if len(self._buffer) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        self.position = offset + (self.position if whence == 1 else self.size if whence == 2 else 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        return b''
+
+    def flush(self):
+        if self._buffer:
+            self.sink(self._offset, bytes(self._buffer))
+            self._offset += len(self._buffer)
+            self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_FAILED = object()
+
+
+class _Task:
+    # One file in the pipeline. Readers and writers are not tied to a file:
+    # a task is queued for reading while it has room for more chunks, and for
+    # writing while it has writes waiting, and every turn does one chunk
+    # before the task goes to the back of the queue. A task is in each queue
+    # at most once, which keeps its chunks and its writes in order.
+
+    def __init__(self, job, queued, read_queue, write_queue):
+        self.job = job
+        self.queued = queued
+        self.read_queue = read_queue
+        self.write_queue = write_queue
+        self.lock = Lock()
+        # Chunks read ahead: credits + queued chunks stay at QUEUE_CHUNKS.
+        self.chunks = Queue()
+        self.credits = QUEUE_CHUNKS
+        self.reading = True
+        self.read_done = False
+        self.cancelled = False
+        self.resource = None
+        self.digest = None
+        self.writes = deque()
+        self.write_slots = Semaphore(QUEUE_CHUNKS)
+        self.writing = False
+        self.destination = None
+        self.write_failed = False
+        self.output = StagedOutput(self.put_write)
+        self.read = 0.0
+        self.write = 0.0
+        self.encoded = False
+        self.converted = False
+        read_queue.put(self)
+
+    def take_chunk(self):
+        chunk = self.chunks.get()
+        with self.lock:
+            self.credits += 1
+            if not self.reading and not self.read_done:
+                self.reading = True
+                self.read_queue.put(self)
+        return chunk
+
+    def read_turn(self, throttle):
+        # Called by a reader: reads one chunk, then queues the task again if
+        # it may read ahead further.
+        item = None
+        if not self.cancelled:
+            start = perf_counter()
+            try:
+                if self.resource is None:
+                    self.resource = open(self.job[0], 'rb')
+                item = self.resource.read(CHUNK_SIZE)
+                if throttle is not None and item:
+                    throttle.consume(len(item))
+            except Exception:
+                item = _FAILED
+            self.read += perf_counter() - start
+            if not item:
+                item = None
+            elif item is not _FAILED and self.digest is not None:
+                self.digest[1].update(item)
+            self.chunks.put(item)
+        with self.lock:
+            self.credits -= 1
+            if self.cancelled or item is None or item is _FAILED:
+                self._stop_reading()
+            elif self.credits > 0:
+                self.read_queue.put(self)
+            else:
+                self.reading = False
+
+    def _stop_reading(self):
+        self.reading = False
+        self.read_done = True
+        if self.resource is not None:
+            self.resource.close()
+            self.resource = None
+
+    def cancel(self):
+        # The encoder gave up on the file: stop reading it.
+        with self.lock:
+            self.cancelled = True
+            if not self.reading:
+                self._stop_reading()
+
+    def put_write(self, offset, data):
+        # Blocks the encoder while QUEUE_CHUNKS writes of the file wait.
+        self.write_slots.acquire()
+        with self.lock:
+            self.writes.append((offset, data))
+            if not self.writing:
+                self.writing = True
+                self.write_queue.put(self)
+
+    def end(self):
+        self.put_write(None, None)
+
+    def write_turn(self, throttle):
+        # Called by a writer: does one write, or moves the finished file into
+        # place. Returns True once the file is done.
+        with self.lock:
+            offset, data = self.writes.popleft()
+        finished = data is None
+        try:
+            writing_path = partial_path(self.job[1])
+            if not finished and not self.write_failed:
+                start = perf_counter()
+                try:
+                    if throttle is not None:
+                        throttle.consume(len(data))
+                    if self.destination is None:
+                        self.destination = open(writing_path, 'wb')
+                    if self.destination.tell() != offset:
+                        self.destination.seek(offset)
+                    self.destination.write(data)
+                except Exception:
+                    self.write_failed = True
+                self.write += perf_counter() - start
+            elif finished:
+                return self._finish(writing_path)
+        finally:
+            self.write_slots.release()
+            with self.lock:
+                if self.writes:
+                    self.write_queue.put(self)
+                else:
+                    self.writing = False
+        return False
+
+    def _finish(self, writing_path):
+        start = perf_counter()
+        try:
+            if self.destination is None and self.encoded and not self.write_failed:
+                self.destination = open(writing_path, 'wb')
+            if self.destination is not None:
+                self.destination.close()
+            if self.encoded and not self.write_failed:
+                replace(writing_path, self.job[1])
+                self.converted = True
+        except Exception:
+            pass
+        finally:
+            if not self.converted:
+                discard(writing_path)
+        self.write += perf_counter() - start
+        return True
+
+
+def convert_pipeline(jobs, encoder, readers=READERS, workers=1, writers=WRITERS, throttle=None, on_success=None,
+                     on_failure=None, should_stop=None, on_result=None, metrics=None, on_start=None):
+    # Same contract as converter.convert_files, for encoders whose streams
+    # accept a file object (encoder.staged). Every file goes through three
+    # stages with their own threads: `readers` read the raw input in
+    # CHUNK_SIZE pieces, `workers` encode it and `writers` write the output
+    # under its partial name and move it into place. A file keeps one
+    # encoding thread from start to end, so up to `workers` files are in
+    # flight; readers and writers serve all of them a chunk at a time (see
+    # _Task). At most a few chunks per file are held in memory. on_start is
+    # called from the encoding thread; if it raises, no new files are
+    # started and the error is raised here once the running ones are done.
+    jobs = iter(jobs)
+    jobs_lock = Lock()
+    stop = Event()
+    read_queue = Queue()
+    write_queue = Queue()
+    results = Queue()
+    started = perf_counter()
+    exhausted = Event()
+    taken = [0]
+    errors = []
+
+    def next_job():
+        with jobs_lock:
+            if stop.is_set():
+                return None
+            job = next(jobs, None)
+            if job is None:
+                exhausted.set()
+            return job
+
+    def read_stage():
+        while True:
+            task = read_queue.get()
+            if task is None:
+                return
+            task.read_turn(throttle)
+
+    def encode_stage():
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            if on_start is not None:
+                try:
+                    on_start(*job)
+                except BaseException as error:
+                    errors.append(error)
+                    stop.set()
+                    return
+            # Counted once it is sure to get a result.
+            with jobs_lock:
+                taken[0] += 1
+            task = _Task(job, perf_counter() - started, read_queue, write_queue)
+            stream = None
+            chunk = b''
+            try:
+                task.digest = encoder.new_digest()
+                stream = encoder.open_input(task.output, job[0])
+                while True:
+                    chunk = task.take_chunk()
+                    if chunk is None or chunk is _FAILED:
+                        break
+                    stream.write(chunk)
+                if chunk is None:
+                    task.encoded = stream.close()
+                    task.output.flush()
+                else:
+                    stream.abort()
+            except Exception:
+                task.encoded = False
+                if stream is not None:
+                    try:
+                        stream.abort()
+                    except Exception:
+                        pass
+            finally:
+                if chunk is not None and chunk is not _FAILED:
+                    task.cancel()
+                task.end()
+
+    def write_stage():
+        while True:
+            task = write_queue.get()
+            if task is None:
+                return
+            if task.write_turn(throttle):
+                if task.converted:
+                    encoder.keep_digest(task.job[0], task.digest)
+                results.put((task, task.converted, perf_counter()))
+
+    stages = [Thread(target=read_stage, daemon=True) for _ in range(max(1, readers))] + \
+             [Thread(target=write_stage, daemon=True) for _ in range(max(1, writers))]
+    encoders = [Thread(target=encode_stage, daemon=True) for _ in range(max(1, workers))]
+    for thread in stages + encoders:
+        thread.start()
+    received = 0
+    try:
+        while True:
+            if should_stop is not None and not stop.is_set() and should_stop():
+                stop.set()
+            try:
+                task, converted, done = results.get(timeout=POLL_INTERVAL)
+            except Empty:
+                # Once no encoder is left, every file they took has a result.
+                if not any(thread.is_alive() for thread in encoders) and received == taken[0]:
+                    if errors:
+                        raise errors[0]
+                    return exhausted.is_set() and not stop.is_set()
+                continue
+            received += 1
+            callback = on_success if converted else on_failure
+            if callback is not None:
+                callback(*task.job)
+            if on_result is not None or metrics is not None:
+                file_metrics = FileMetrics(task.job[0], task.job[1], converted, task.queued, done - started - task.queued,
+                                           {'read': task.read, 'write': task.write},
+                                           _size(task.job[0]), _size(task.job[1]) if converted else 0)
+                if metrics is not None:
+                    metrics.add(file_metrics)
+                if on_result is not None:
+                    on_result(file_metrics)
+    finally:
+        for _ in range(max(1, readers)):
+            read_queue.put(None)
+        for _ in range(max(1, writers)):
+            write_queue.put(None)
+
+
+def throttled(convert_batch, throttle):
+    # For conversions that do their own I/O (ffmpeg, fan-out): a batch's
+    # input is charged to the throttle before it runs and its outputs after,
+    # which keeps the average rate under the limit.
+    def convert_throttled(jobs):
+        throttle.consume(sum(_size(job[0]) for job in jobs))
+        results = convert_batch(jobs)
+        throttle.consume(sum(_size(job[1]) for job, converted in zip(jobs, results) if converted))
+        return results
+    return convert_throttled
+
+
+def convert_all(jobs, encoder, settings, workers=None, on_success=None, on_failure=None, should_stop=None,
+                on_result=None, metrics=None, on_start=None):
+    # The staged pipeline runs when "pipeline" is set, or "io_limit", and the
+    # encoder supports it. ffmpeg reads and writes the files itself, so it
+    # always runs whole (batched) conversions, throttled per batch. With
+    # local disks the plain pool is just as fast; stages pay off when reads
+    # and writes wait on network storage.
+    workers = workers or int(settings.get("workers", default_workers()))
+    throttle = throttle_for(settings)
+    if encoder.staged and (settings.get("pipeline") or throttle is not None):
+        return convert_pipeline(jobs, encoder, int(settings.get("readers", READERS)), workers,
+                                int(settings.get("writers", WRITERS)), throttle, on_success,
+                                on_failure, should_stop, on_result, metrics, on_start)
+    convert = encoder.convert
+    convert_batch = encoder.convert_batch
+    if throttle is not None:
+        convert_batch = throttled(convert_batch, throttle)
+        convert = lambda resource_path, destination_path: convert_batch([(resource_path, destination_path)])[0]
+    return convert_files(jobs, convert, workers, on_success, on_failure, should_stop,
+                         encoder.batch_size, convert_batch, on_result, metrics, on_start)
@@ -0,0 +1,111 @@
+from collections import namedtuple
+from os import path, makedirs, sep
+
+import re
+
+from encoders import discard_partials
+from journal import JournalJob
+from manifest import diff_manifest
+from tree_diff import scan_tree
+
+KIM_DIRNAME = re.compile(r"^[0-9]{7}$")
+DUPLICATE_SUFFIX = '_duplicate'
+
+
+class Plan(namedtuple('Plan', ['source_root', 'destination_root', 'files', 'jobs', 'dirs', 'duplicates'])):
+    # Everything a conversion run needs, computed once at scan time: the jobs
+    # (JournalJob, paths relative to the roots), the destination directories
+    # to create and the KIM directories whose new files go to _duplicate.
+    __slots__ = ()
+
+    @property
+    def converted(self):
+        return self.files - len(self.jobs)
+
+    def resources(self):
+        return {path.join(self.source_root, job.source): path.join(self.destination_root, job.output)
+                for job in self.jobs}
+
+    def largest_first(self):
+        # Longest processing time first: a big capture started last would
+        # otherwise run on alone after every other file is done.
+        return self._replace(jobs=tuple(sorted(self.jobs, key=lambda job: job.size, reverse=True)))
+
+    def discard_partials(self):
+        # Runs without a journal can't tell which outputs an interrupted run
+        # was writing, so the partial output of every pending job goes.
+        for job in self.jobs:
+            discard_partials(path.join(self.destination_root, job.output))
+
+    def make_dirs(self):
+        # One makedirs per leaf; sorting by components puts every directory
+        # right before its descendants.
+        makedirs(self.destination_root, exist_ok=True)
+        dirs = sorted(self.dirs, key=lambda dirname: dirname.split(sep))
+        for index, dirname in enumerate(dirs):
+            if index + 1 < len(dirs) and dirs[index + 1].startswith(dirname + sep):
+                continue
+            makedirs(path.join(self.destination_root, dirname), exist_ok=True)
+
+
+def plan_conversion(source_root, destination_root, extension, manifest=None, hash_name=None, duplicates=False,
+                    source=None, input_format=None, hashed=None):
+    # One scan of the source tree (through diff_manifest) gives the pending
+    # files and the directories to mirror. With duplicates=True new files in
+    # a KIM directory that was already converted go to <dir>_duplicate
+    # instead; only directories holding new files are checked for that.
+    diff = diff_manifest(source_root, destination_root, extension, manifest, hash_name, source, input_format, hashed)
+    stats = diff.source.stats
+    digests = diff.digests or {}
+    dirs = list(diff.source.dirs)
+    duplicate_dirs = set()
+    if duplicates:
+        for dirname in {path.dirname(relpath) for relpath in diff.new_files}:
+            if KIM_DIRNAME.fullmatch(path.basename(dirname)) and path.isdir(path.join(destination_root, dirname)):
+                duplicate_dirs.add(dirname)
+                dirs.append(dirname + DUPLICATE_SUFFIX)
+    jobs = []
+    for relpath in diff.new_files:
+        dirname, filename = path.split(relpath)
+        if dirname in duplicate_dirs:
+            output = path.join(dirname + DUPLICATE_SUFFIX, filename) + extension
+        else:
+            output = relpath + extension
+        jobs.append(JournalJob(relpath, output, *stats[relpath], digests.get(relpath)))
+    return Plan(source_root, destination_root, len(diff.source.files), tuple(jobs), tuple(dirs),
+                frozenset(duplicate_dirs))
+
+
+def plan_jobs(source_root, destination_root, jobs):
+    # A plan for jobs that are already known: an interrupted run's journal,
+    # or files that landed while watching.
+    jobs = tuple(jobs)
+    dirs = {path.dirname(job.output) for job in jobs} - {''}
+    return Plan(source_root, destination_root, len(jobs), jobs, tuple(dirs), frozenset())
+
+
+def plan_targets(source_root, targets, manifests=None, hash_name=None, duplicates=False, input_format=None,
+                 source=None):
+    # One plan per (destination_root, extension) target, all from a single
+    # scan of the source tree (source, if there is one already). A file that
+    # changed for several targets is hashed once.
+    source = source or scan_tree(source_root, stat=True)
+    manifests = manifests or [None] * len(targets)
+    hashed = {}
+    return [plan_conversion(source_root, destination_root, extension, manifest, hash_name, duplicates, source,
+                            input_format, hashed)
+            for (destination_root, extension), manifest in zip(targets, manifests)]
+
+
+def fanout_resources(plans):
+    # Absolute source path -> one destination per plan, None where that
+    # target is up to date, for every file pending in any of the plans.
+    # Largest files first, as with Plan.largest_first().
+    outputs = {}
+    sizes = {}
+    for index, plan in enumerate(plans):
+        for job in plan.jobs:
+            outputs.setdefault(job.source, [None] * len(plans))[index] = path.join(plan.destination_root, job.output)
+            sizes[job.source] = job.size
+    return {path.join(plans[0].source_root, source): tuple(outputs[source])
+            for source in sorted(outputs, key=sizes.get, reverse=True)}
@@ -0,0 +1,210 @@
+from math import ceil, gcd
+from os import path
+
+import numpy as np
+
+from encoders import CHUNK_SIZE, SAMPLE_WIDTH, EncoderStream
+
+# Sinc lobes on each side of a resampled sample, and the Kaiser window's
+# shape: about 80 dB of stopband, well past what 16-bit output can show.
+ZERO_CROSSINGS = 16
+KAISER_BETA = 8.6
+PROFILE_KEYS = ('channels', 'frequency', 'gain_db', 'normalize_db', 'trim_db')
+
+
+class Resampler:
+    # Band-limited sample rate conversion by up/down (the reduced ratio of
+    # the rates), fed block by block. Output sample n sits at input time
+    # n * down / up and is the weighted sum of the 2 * width input samples
+    # around it; the weights (a Kaiser windowed sinc, cut off below the lower
+    # Nyquist frequency) come from a table with one row per fractional
+    # position. The loop runs over those taps, every step covering a block.
+
+    def __init__(self, input_rate, output_rate, channels):
+        divisor = gcd(input_rate, output_rate)
+        self.up = output_rate // divisor
+        self.down = input_rate // divisor
+        cutoff = min(1.0, self.up / self.down)
+        self.width = int(ceil(ZERO_CROSSINGS / cutoff))
+        self.offsets = range(1 - self.width, self.width + 1)
+        distance = np.arange(self.up)[:, None] / self.up - np.array(self.offsets)[None, :]
+        window = np.i0(KAISER_BETA * np.sqrt(np.clip(1 - (distance / self.width) ** 2, 0, None))) / np.i0(KAISER_BETA)
+        self.weights = cutoff * np.sinc(cutoff * distance) * window
+        self.weights /= self.weights.sum(axis=1, keepdims=True)
+        # Input before the first sample is silence.
+        self.buffer = np.zeros((self.width - 1, channels))
+        self.start = 1 - self.width
+        self.consumed = 0
+        self.produced = 0
+
+    def _produce(self, end):
+        samples = np.arange(self.produced, max(self.produced, end)) * self.down
+        base = samples // self.up - self.start
+        phase = samples % self.up
+        out = np.zeros((len(samples), self.buffer.shape[1]))
+        for tap, offset in enumerate(self.offsets):
+            out += self.weights[phase, tap][:, None] * self.buffer[base + offset]
+        self.produced = max(self.produced, end)
+        # Keep what the next output sample still reaches back to.
+        keep = self.produced * self.down // self.up - self.width + 1 - self.start
+        if keep > 0:
+            self.buffer = self.buffer[keep:]
+            self.start += keep
+        return out
+
+    def process(self, block):
+        self.buffer = np.concatenate((self.buffer, block))
+        self.consumed += len(block)
+        # Output samples whose last tap has arrived.
+        available = self.start + len(self.buffer) - self.width
+        return self._produce(-(-available * self.up // self.down))
+
+    def flush(self):
+        # The input is over: it is followed by silence.
+        self.buffer = np.concatenate((self.buffer, np.zeros((self.width, self.buffer.shape[1]))))
+        return self._produce(-(-self.consumed * self.up // self.down))
+
+
+class PreprocessStream(EncoderStream):
+    # Takes the raw s16le input, trims it to [first, last) frames, mixes the
+    # channels, resamples and applies gain, and writes the result to the
+    # encoder's stream. Every step works on whole chunks.
+
+    def __init__(self, preprocessor, stream, gain, first=0, last=None):
+        EncoderStream.__init__(self, preprocessor.frame_size)
+        self.preprocessor = preprocessor
+        self.stream = stream
+        self.gain = gain
+        self.first = first
+        self.last = last
+        self.position = 0
+        self.resampler = None
+        if preprocessor.frequency != preprocessor.input_frequency:
+            self.resampler = Resampler(preprocessor.input_frequency, preprocessor.frequency, preprocessor.channels)
+
+    def _write_frames(self, frames):
+        block = np.frombuffer(frames, '<i2').reshape(-1, self.preprocessor.input_channels)
+        start = self.position
+        self.position += len(block)
+        if self.first > start or self.last is not None:
+            block = block[max(0, self.first - start):None if self.last is None else max(0, self.last - start)]
+        if len(block):
+            block = self.preprocessor.mix(block.astype(np.float64))
+            self._emit(self.resampler.process(block) if self.resampler is not None else block)
+
+    def _emit(self, block):
+        if not len(block):
+            return
+        if self.gain != 1.0:
+            block = block * self.gain
+        block = np.clip(np.rint(block), -32768, 32767)
+        self.stream.write(block.astype('<i2').tobytes())
+
+    def _finish(self):
+        try:
+            if self.resampler is not None:
+                self._emit(self.resampler.flush())
+        except BaseException:
+            self.stream.abort()
+            raise
+        return self.stream.close()
+
+    def abort(self):
+        self.stream.abort()
+
+
+class Preprocessor:
+    # One profile from config.json:
+    #   "channels": 1 to downmix, or a list of the input channels to keep
+    #   "frequency": output sample rate
+    #   "gain_db": fixed gain
+    #   "normalize_db": scale the loudest sample to this many dBFS
+    #   "trim_db": drop leading and trailing frames quieter than this
+    # The input format is "frequency" and "channels" of convertation_settings.
+    # Normalising and trimming need the whole input, so they cost one more
+    # pass over it (memory-mapped, a chunk at a time) before encoding.
+
+    def __init__(self, settings, profile):
+        unknown = set(profile) - set(PROFILE_KEYS)
+        if unknown:
+            raise ValueError("Unknown profile settings: {}".format(", ".join(sorted(unknown))))
+        self.input_frequency = int(settings["frequency"])
+        self.input_channels = int(settings["channels"])
+        self.frame_size = SAMPLE_WIDTH * self.input_channels
+        channels = profile.get("channels", self.input_channels)
+        self.select = None
+        if isinstance(channels, list):
+            if not channels or not all(0 <= int(channel) < self.input_channels for channel in channels):
+                raise ValueError("Profile channels must be input channels between 0 and {}".format(self.input_channels - 1))
+            self.select = [int(channel) for channel in channels]
+            self.channels = len(self.select)
+        else:
+            self.channels = int(channels)
+            if self.channels not in (1, self.input_channels) and self.input_channels != 1:
+                raise ValueError("Can't mix {} channels into {}".format(self.input_channels, self.channels))
+        self.frequency = int(profile.get("frequency", self.input_frequency))
+        if self.frequency <= 0:
+            raise ValueError("Profile frequency must be positive")
+        self.gain = 10 ** (float(profile.get("gain_db", 0)) / 20)
+        self.target = None
+        if profile.get("normalize_db") is not None:
+            self.target = 32767 * 10 ** (float(profile["normalize_db"]) / 20)
+        self.threshold = None
+        if profile.get("trim_db") is not None:
+            self.threshold = 32768 * 10 ** (float(profile["trim_db"]) / 20)
+
+    def mix(self, block):
+        if self.select is not None:
+            return block[:, self.select]
+        if self.channels == self.input_channels:
+            return block
+        if self.channels == 1:
+            return block.mean(axis=1, keepdims=True)
+        return np.repeat(block, self.channels, axis=1)
+
+    def analyse(self, resource_path):
+        # (peak, first, last) of the mixed input: its loudest sample and the
+        # frames from the first to past the last one above the trim threshold.
+        frames = path.getsize(resource_path) // self.frame_size
+        if not frames:
+            return 0.0, 0, 0
+        samples = np.memmap(resource_path, '<i2', 'r', shape=(frames, self.input_channels))
+        peak = 0.0
+        first = None
+        last = 0
+        step = CHUNK_SIZE // self.frame_size
+        for start in range(0, frames, step):
+            level = np.abs(self.mix(samples[start:start + step].astype(np.float64))).max(axis=1)
+            peak = max(peak, float(level.max()))
+            if self.threshold is not None:
+                loud = np.flatnonzero(level >= self.threshold)
+                if len(loud):
+                    first = start + int(loud[0]) if first is None else first
+                    last = start + int(loud[-1]) + 1
+        # Unmaps the file.
+        del samples
+        if self.threshold is None:
+            return peak, 0, frames
+        return peak, first or 0, last
+
+    def open(self, stream, resource_path=None):
+        gain = self.gain
+        first, last = 0, None
+        if self.target is not None or self.threshold is not None:
+            if resource_path is None:
+                raise ValueError("Normalising and trimming need the input file")
+            peak, first, last = self.analyse(resource_path)
+            if self.target is not None and peak:
+                gain *= self.target / peak
+        return PreprocessStream(self, stream, gain, first, last)
+
+
+def preprocessor_for(settings):
+    # The profile named by "profile" among "profiles", or None without one.
+    name = settings.get("profile")
+    if not name:
+        return None
+    profiles = settings.get("profiles") or {}
+    if name not in profiles:
+        raise ValueError("Unknown preprocessing profile {}".format(name))
+    return Preprocessor(settings, profiles[name])
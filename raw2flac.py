@@ -1,103 +1,493 @@
-from shutil import rmtree
-from os import walk, path, mkdir
-from pydub import AudioSegment
-from sys import argv, exit
+from os import path, environ
+from sys import argv, exit, stdin
+from argparse import ArgumentParser
+from secrets import token_urlsafe
+
+import json
+
+from converter import default_workers
+from pipeline import convert_all, READERS, WRITERS
+from manifest import Manifest, repair_manifest
+from encoders import get_encoder, raw_format, FanoutEncoder
+from watcher import watch_tree, STABLE_MS
+from metrics import RunMetrics
+from journal import Journal, JournalJob, output_settings
+from planner import plan_conversion, plan_jobs, plan_targets, fanout_resources
+from tree_diff import scan_tree
+from distributed import Coordinator, serve_coordinator, run_worker, LEASE_SIZE, LEASE_TIMEOUT
 
 RESULT_DIRNAME = 'Result'
 RESULT_CONVERTED_DIRNAME = 'Result_mp3'
 FILE_EXTENSION = '.mp3'
+# (destination, extension) of the --also outputs.
+EXTRA_TARGETS = []
+WORKERS = default_workers()
+HASH_NAME = None
+ASSUME_YES = False
+DRY_RUN = False
+VERIFY = False
+JSON_PROGRESS = False
+METRICS_JSON = None
+METRICS_PROMETHEUS = None
+LEASE_SIZE_SETTING = LEASE_SIZE
+LEASE_TIMEOUT_SETTING = LEASE_TIMEOUT
+TOKEN = None
+SETTINGS = {
+    "frequency": "22050",
+    "channels": "2",
+    "encoder": "auto",
+    "batch_size": 16
+}
 SUPPORTED_FORMATS = [
     'mp3',
     'flac'
 ]
 
-def get_trees():
-  result_files = []
-  for root, _, files in walk(RESULT_DIRNAME):
-    for filename in files:
-      result_files.append(path.join(path.realpath(root), filename))
-
-  result_converted_files = []
-  for root, _, files in walk(RESULT_CONVERTED_DIRNAME):
-    for filename in files:
-      result_converted_files.append(path.join(path.realpath(root), filename))
-
-  return result_files, result_converted_files
-
-def compare_trees():
-  result_files, result_converted_files = get_trees()
-  new_files = []
-  for file in result_files:
-    path = list(file.partition(RESULT_DIRNAME))
-    path[1] = RESULT_CONVERTED_DIRNAME
-    if not ''.join(path) + FILE_EXTENSION in result_converted_files:
-      new_files.append(file)
-  return new_files
+def say(text):
+    # Human readable output; replaced by JSON lines events with --json.
+    if not JSON_PROGRESS:
+        print(text)
 
-def make_result_tree():
-    size = 0
-    for _, _, files in walk(RESULT_DIRNAME):
-        size += len(files)
-    new_files = compare_trees()
-    if not new_files:
-      print("All resource from result folder is already converted")
-      return
-    if not path.exists(RESULT_CONVERTED_DIRNAME):
-        print("Creating result directory ({})".format(RESULT_CONVERTED_DIRNAME))
-        mkdir(RESULT_CONVERTED_DIRNAME)
+def emit(event, **fields):
+    if JSON_PROGRESS:
+        fields["event"] = event
+        print(json.dumps(fields), flush=True)
+
+def confirm(prompt):
+    # A closed stdin (cron, a pipe) answers no.
+    if ASSUME_YES:
+        return True
+    try:
+        return input(prompt).lower() == 'y'
+    except EOFError:
+        say("\nNo answer on stdin, nothing converted. Pass --yes to convert without asking")
+        return False
+
+def compare_trees(manifest=None):
+  return plan_conversion(RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, FILE_EXTENSION, manifest, HASH_NAME,
+                         input_format=raw_format(SETTINGS))
+
+def verify_manifest(manifest, destination_root, extension, source=None):
+    # With --dry-run the manifest is a read-only one and the repair stays in
+    # memory, for the plan that follows.
+    added, removed = repair_manifest(RESULT_DIRNAME, destination_root, extension, manifest, source,
+                                     input_format=raw_format(SETTINGS))
+    say("Manifest in {} verified: {} records added, {} records removed".format(destination_root, added, removed))
+    emit("verify", destination=destination_root, format=extension[1:], added=added, removed=removed)
+
+def ask_to_convert(files, converted, formats, pending):
     text_template = """
     Current result folder contain {} files.
     {} files is already converted to {}.
     Do you want to converted another {} files?"""
-    print(text_template.format(size, size-len(new_files), FILE_EXTENSION[1:], len(new_files)))
-    if input("y/n ").lower() == 'y':
-        currentIndex = 1
-        for root, dirs, files in walk(RESULT_DIRNAME):
-            for dirname in dirs:
-                currentDirName = path.join(RESULT_CONVERTED_DIRNAME, '\\'.join(root.split('\\')[1:]), dirname)
-                if not path.exists(currentDirName):
-                    mkdir(currentDirName)
-            for filename in files:
-                currentDirName = path.join(RESULT_CONVERTED_DIRNAME, '\\'.join(root.split('\\')[1:]))
-                if path.join(path.realpath(root), filename) in new_files:
-                    if FILE_EXTENSION == '.flac':
-                        AudioSegment.from_raw(path.join(root, filename),
-                                              sample_width=2,
-                                              frame_rate=22050,
-                                              channels=2).export(path.join(currentDirName, filename) + FILE_EXTENSION,
-                                                                 format='flac')
-                    elif FILE_EXTENSION == '.mp3':
-                        AudioSegment.from_raw(path.join(root, filename),
-                                              sample_width=2,
-                                              frame_rate=22050,
-                                              channels=2).export(path.join(currentDirName, filename) + FILE_EXTENSION,
-                                                                 format='mp3')
-                    print("\t{}..{}\t{} successfully converted to {}".format(currentIndex, len(new_files), path.join(root, filename), FILE_EXTENSION[1:]))
-                    currentIndex += 1
+    say(text_template.format(files, converted, formats, pending))
+    return confirm("y/n ")
+
+def emit_result(file_metrics):
+    fields = file_metrics.as_dict()
+    fields["status"] = "converted" if fields.pop("converted") else "failed"
+    emit("file", **fields)
+
+def run_conversion(resources, encoder, manifests, converted, failed, started=None, finished=None):
+    # What convert_new_files and convert_targets share: runs the jobs with
+    # metrics (and --json results), flushes the manifests, calls
+    # finished(completed) and reports the metrics.
+    metrics = RunMetrics()
+    completed = False
+    try:
+        completed = convert_all(resources, encoder, SETTINGS, WORKERS, converted, failed,
+                                on_result=emit_result if JSON_PROGRESS else None, metrics=metrics, on_start=started)
+    finally:
+        for manifest in manifests:
+            manifest.flush()
+        metrics.finish()
+        if finished is not None:
+            finished(completed)
+    report_metrics(metrics, completed)
+    return completed
+
+def convert_new_files(manifest, plan, journal=None):
+    encoder = get_encoder(FILE_EXTENSION[1:], SETTINGS)
+    plan.make_dirs()
+    planned = {job.source: job for job in plan.jobs}
+    progress = {'index': 1, 'failed': 0}
+    def converted(resource_path, destination_path):
+        job = planned[path.relpath(resource_path, start=RESULT_DIRNAME)]
+        manifest.record(job.source, job.size, job.mtime_ns, job.output, encoder.digests.pop(resource_path, job.digest))
+        if journal is not None:
+            journal.done(job.source)
+        say("\t{}..{}\t{} successfully converted to {}".format(progress['index'], len(plan.jobs), resource_path, FILE_EXTENSION[1:]))
+        progress['index'] += 1
+    def failed(resource_path, destination_path):
+        progress['failed'] += 1
+        if journal is not None:
+            journal.failed(path.relpath(resource_path, start=RESULT_DIRNAME))
+        say("\t{} failed to convert to {}".format(resource_path, FILE_EXTENSION[1:]))
+    def started(resource_path, destination_path):
+        journal.started(path.relpath(resource_path, start=RESULT_DIRNAME))
+    def finished(completed):
+        if journal is None:
+            return
+        if completed:
+            journal.complete()
+        else:
+            journal.sync()
+            journal.close()
+    completed = run_conversion(plan.largest_first().resources().items(), encoder, [manifest], converted, failed,
+                               started if journal is not None else None, finished)
+    return completed and not progress['failed']
+
+def report_metrics(metrics, completed):
+    say(metrics.format_summary())
+    if METRICS_JSON:
+        metrics.write_json(METRICS_JSON)
+    if METRICS_PROMETHEUS:
+        metrics.write_prometheus(METRICS_PROMETHEUS)
+    emit("finish", completed=completed, **metrics.summary())
+
+def convert_targets(targets, manifests, plans):
+    # One read of every pending file feeds the encoders of all the targets
+    # that miss it; each target's manifest records its own outputs, also
+    # those of a file that failed for another target.
+    encoder = FanoutEncoder([get_encoder(extension[1:], SETTINGS) for _, extension in targets])
+    for plan in plans:
+        plan.make_dirs()
+        plan.discard_partials()
+    resources = fanout_resources(plans)
+    planned = [{job.source: job for job in plan.jobs} for plan in plans]
+    formats = ", ".join(extension[1:] for _, extension in targets)
+    progress = {'index': 1, 'failed': 0}
+    def record(resource_path, destination_paths, written):
+        relpath = path.relpath(resource_path, start=RESULT_DIRNAME)
+        digest = encoder.digests.pop(resource_path, None)
+        for manifest, jobs, destination_path in zip(manifests, planned, destination_paths):
+            job = jobs.get(relpath)
+            if job is not None and destination_path in written:
+                manifest.record(job.source, job.size, job.mtime_ns, job.output, digest or job.digest)
+    def converted(resource_path, destination_paths):
+        record(resource_path, destination_paths, destination_paths)
+        say("\t{}..{}\t{} successfully converted to {}".format(progress['index'], len(resources), resource_path,
+                                                               ", ".join(path.splitext(output)[1][1:] for output in destination_paths if output)))
+        progress['index'] += 1
+    def failed(resource_path, destination_paths):
+        progress['failed'] += 1
+        written = encoder.written.pop(resource_path, ())
+        record(resource_path, destination_paths, written)
+        say("\t{} failed to convert to {}".format(resource_path, ", ".join(
+            path.splitext(output)[1][1:] for output in destination_paths if output and output not in written)))
+    completed = run_conversion(resources.items(), encoder, manifests, converted, failed)
+    return completed and not progress['failed']
+
+def resume_result_tree(manifest, journal, resume):
+    # Finish an interrupted run from its journal, without scanning anything.
+    for job in resume.done:
+        manifest.record(job.source, job.size, job.mtime_ns, job.output, job.digest)
+    manifest.flush()
+    plan = plan_jobs(RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, resume.pending)
+    emit("resume", done=len(resume.done), pending=len(plan.jobs), in_flight=len(resume.in_flight))
+    say("Found an interrupted conversion: {} files done, {} files left".format(len(resume.done), len(plan.jobs)))
+    if DRY_RUN:
+        for resource_path, destination_path in plan.resources().items():
+            say("\t{} -> {}".format(resource_path, destination_path))
+        return True
+    if not confirm("Resume? y/n "):
+        say("OK. See you later")
+        return True
+    journal.reopen()
+    try:
+        return convert_new_files(manifest, plan, journal)
+    finally:
+        manifest.close()
+
+def make_result_tree():
+    manifest = Manifest(RESULT_CONVERTED_DIRNAME, read_only=DRY_RUN)
+    if VERIFY:
+        verify_manifest(manifest, RESULT_CONVERTED_DIRNAME, FILE_EXTENSION)
+    journal = Journal(RESULT_CONVERTED_DIRNAME)
+    resume = journal.resume(read_only=DRY_RUN)
+    if resume is not None and resume.matches(RESULT_DIRNAME, output_settings(FILE_EXTENSION, SETTINGS)):
+        return resume_result_tree(manifest, journal, resume)
+    if resume is not None:
+        say("Ignoring an interrupted conversion of other files or to another format")
+    plan = compare_trees(manifest)
+    emit("scan", files=plan.files, converted=plan.converted, pending=len(plan.jobs))
+    if not plan.jobs:
+      say("All resource from result folder is already converted")
+      return True
+    if DRY_RUN:
+        for job in plan.jobs:
+            resource_path = path.join(RESULT_DIRNAME, job.source)
+            destination_path = path.join(RESULT_CONVERTED_DIRNAME, job.output)
+            say("\t{} -> {}".format(resource_path, destination_path))
+            emit("pending", source=resource_path, destination=destination_path, input_bytes=job.size)
+        return True
+    if not path.exists(RESULT_CONVERTED_DIRNAME):
+        say("Creating result directory ({})".format(RESULT_CONVERTED_DIRNAME))
+    if ask_to_convert(plan.files, plan.converted, FILE_EXTENSION[1:], len(plan.jobs)):
+        journal.plan(RESULT_DIRNAME, plan.jobs, output_settings(FILE_EXTENSION, SETTINGS))
+        try:
+            if not convert_new_files(manifest, plan, journal):
+                return False
+        finally:
+            manifest.close()
     else:
-        print("OK. See you later")
-        return
-    print("\t All new files successfully converted to {}".format(FILE_EXTENSION[1:]))
+        say("OK. See you later")
+        return True
+    say("\t All new files successfully converted to {}".format(FILE_EXTENSION[1:]))
+    return True
 
-if __name__ == "__main__":
-    if len(argv) > 1:
-        RESULT_DIRNAME = argv[1]
-    if len(argv) > 2:
-        RESULT_CONVERTED_DIRNAME = argv[2]
-    if len(argv) > 3:
-        FILE_EXTENSION = '.' + argv[3]
-    if len(argv) > 4:
-        print("Too many arguments.")
-        print("Usage: raw2flac RESULT_DIRNAME DESTINATION_DIRNAME FILE_FORMAT")
-        print("default: RESULT_DIRNAME - {} \n\t DESTINATION_DIRNAME - {} \n\t FILE_FORMAT - {}".format(RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, FILE_EXTENSION))
-        exit(2)
-    if not FILE_EXTENSION[1:] in SUPPORTED_FORMATS:
-        print("Unknown audio format {}".format(FILE_EXTENSION[1:]))
-        print("Supported formats: {}".format(', '.join(SUPPORTED_FORMATS)))
-        exit(3)
-    print("Start scaning \n\t{} \nto find source file and convert to {} in folder \n\t{}\n".format(path.realpath(RESULT_DIRNAME), FILE_EXTENSION[1:], path.realpath(RESULT_CONVERTED_DIRNAME)))
-    if path.exists(RESULT_DIRNAME):
-        make_result_tree()
+def make_result_trees():
+    # --also: the raw files are read once for every target. A file is pending
+    # when any target misses it, and is only encoded for those. There is no
+    # journal; an interrupted run is picked up from the manifests.
+    targets = [(RESULT_CONVERTED_DIRNAME, FILE_EXTENSION)] + EXTRA_TARGETS
+    # Targets sharing a destination tree share its manifest.
+    shared = {}
+    manifests = [shared.setdefault(path.realpath(destination), Manifest(destination, read_only=DRY_RUN))
+                 for destination, _ in targets]
+    formats = ", ".join(extension[1:] for _, extension in targets)
+    try:
+        source = scan_tree(RESULT_DIRNAME, stat=True)
+        if VERIFY:
+            for (destination, extension), manifest in zip(targets, manifests):
+                verify_manifest(manifest, destination, extension, source)
+        plans = plan_targets(RESULT_DIRNAME, targets, manifests, HASH_NAME, input_format=raw_format(SETTINGS),
+                             source=source)
+        resources = fanout_resources(plans)
+        emit("scan", files=plans[0].files, converted=plans[0].files - len(resources), pending=len(resources),
+             targets=[{"destination": destination, "format": extension[1:], "pending": len(plan.jobs)}
+                      for (destination, extension), plan in zip(targets, plans)])
+        if not resources:
+            say("All resource from result folder is already converted to {}".format(formats))
+            return True
+        if DRY_RUN:
+            for resource_path, destination_paths in resources.items():
+                outputs = [output for output in destination_paths if output is not None]
+                say("\t{} -> {}".format(resource_path, ", ".join(outputs)))
+                emit("pending", source=resource_path, destinations=outputs, input_bytes=path.getsize(resource_path))
+            return True
+        if not ask_to_convert(plans[0].files, plans[0].files - len(resources), formats, len(resources)):
+            say("OK. See you later")
+            return True
+        if not convert_targets(targets, manifests, plans):
+            return False
+    finally:
+        for manifest in manifests:
+            manifest.close()
+    say("\t All new files successfully converted to {}".format(formats))
+    return True
+
+def watch_result_tree():
+    # Convert whatever is pending, then keep converting files as they land.
+    # The tree is scanned once watching has started, and the pending files go
+    # through the same stability check as new ones.
+    manifest = Manifest(RESULT_CONVERTED_DIRNAME)
+    pending = {}
+    def scan():
+        plan = compare_trees(manifest)
+        pending.update((job.source, job) for job in plan.jobs)
+        say("Converting {} pending files once they are stable".format(len(plan.jobs)))
+        return list(pending)
+    def convert_ready(ready):
+        jobs = []
+        for relpath in sorted(ready):
+            job = pending.pop(relpath, None)
+            if job is None or (job.size, job.mtime_ns) != ready[relpath]:
+                job = JournalJob(relpath, relpath + FILE_EXTENSION, *ready[relpath], None)
+            jobs.append(job)
+        convert_new_files(manifest, plan_jobs(RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, jobs))
+    say("Watching {} for new files (Ctrl+C to stop)".format(path.realpath(RESULT_DIRNAME)))
+    try:
+        watch_tree(RESULT_DIRNAME, convert_ready, STABLE_MS, initial=scan)
+    except KeyboardInterrupt:
+        say("Stop watching")
+    finally:
+        manifest.close()
+
+def coordinate_result_tree(address):
+    # Hand the pending files out to --worker processes instead of converting
+    # them here; the manifest and journal are kept by the coordinator.
+    host, _, port = address.rpartition(':')
+    token = TOKEN or token_urlsafe(16)
+    manifest = Manifest(RESULT_CONVERTED_DIRNAME)
+    journal = Journal(RESULT_CONVERTED_DIRNAME)
+    resume = journal.resume()
+    if resume is not None and resume.matches(RESULT_DIRNAME, output_settings(FILE_EXTENSION, SETTINGS)):
+        for job in resume.done:
+            manifest.record(job.source, job.size, job.mtime_ns, job.output, job.digest)
+        plan = plan_jobs(RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, resume.pending)
+        say("Resuming an interrupted conversion: {} files done, {} files left".format(len(resume.done), len(plan.jobs)))
+        journal.reopen()
     else:
-        print("Can't find result dir with name {}".format(RESULT_DIRNAME))
-    input("Press enter to quit")
\ No newline at end of file
+        plan = compare_trees(manifest)
+        journal.plan(RESULT_DIRNAME, plan.jobs, output_settings(FILE_EXTENSION, SETTINGS))
+    emit("scan", files=plan.files, converted=plan.converted, pending=len(plan.jobs))
+    plan.make_dirs()
+    progress = {'index': 1, 'failed': 0}
+    def leased(worker, jobs):
+        for job in jobs:
+            journal.started(job.source)
+        emit("lease", worker=worker, files=len(jobs))
+    def converted(job):
+        manifest.record(job.source, job.size, job.mtime_ns, job.output, job.digest)
+        journal.done(job.source)
+        say("\t{}..{}\t{} successfully converted to {}".format(progress['index'], len(plan.jobs), job.source, FILE_EXTENSION[1:]))
+        emit("file", source=path.join(RESULT_DIRNAME, job.source), destination=path.join(RESULT_CONVERTED_DIRNAME, job.output),
+             status="converted")
+        progress['index'] += 1
+    def failed(job):
+        progress['failed'] += 1
+        journal.failed(job.source)
+        say("\t{} failed to convert to {}".format(job.source, FILE_EXTENSION[1:]))
+        emit("file", source=path.join(RESULT_DIRNAME, job.source), destination=path.join(RESULT_CONVERTED_DIRNAME, job.output),
+             status="failed")
+    coordinator = Coordinator(plan.largest_first().jobs, LEASE_SIZE_SETTING, LEASE_TIMEOUT_SETTING, leased, converted, failed)
+    try:
+        serve_coordinator(coordinator, output_settings(FILE_EXTENSION, SETTINGS), host or '127.0.0.1', int(port), token,
+                          lambda address: say("Coordinating {} files on {}:{}{}".format(
+                              len(plan.jobs), *address, "" if TOKEN else ", workers need --token " + token)))
+    except KeyboardInterrupt:
+        say("Stop coordinating")
+    finally:
+        manifest.close()
+        if coordinator.done.is_set():
+            journal.complete()
+        else:
+            journal.sync()
+            journal.close()
+    emit("finish", completed=coordinator.done.is_set(), **coordinator.status())
+    return coordinator.done.is_set() and not progress['failed']
+
+def work_result_tree(url):
+    def converted(resource_path, destination_path):
+        say("\t{} successfully converted to {}".format(resource_path, destination_path))
+        emit("file", source=resource_path, destination=destination_path, status="converted")
+    def failed(resource_path, destination_path):
+        say("\t{} failed to convert".format(resource_path))
+        emit("file", source=resource_path, destination=destination_path, status="failed")
+    say("Converting files leased from {}".format(url))
+    try:
+        return run_worker(url, RESULT_DIRNAME, RESULT_CONVERTED_DIRNAME, SETTINGS, TOKEN, WORKERS,
+                          on_success=converted, on_failure=failed)
+    except PermissionError as error:
+        say(str(error))
+        emit("error", message=str(error))
+        return False
+    except KeyboardInterrupt:
+        say("Stop working")
+        return False
+
+def make_parser():
+    parser = ArgumentParser(prog='raw2flac', description="Convert raw s16le captures to flac or mp3.")
+    parser.add_argument('source', nargs='?', default=RESULT_DIRNAME, help="directory with raw files (default: %(default)s)")
+    parser.add_argument('destination', nargs='?', default=RESULT_CONVERTED_DIRNAME, help="destination directory (default: %(default)s)")
+    parser.add_argument('format', nargs='?', choices=SUPPORTED_FORMATS, help="output format (default: {})".format(FILE_EXTENSION[1:]))
+    parser.add_argument('-f', '--format', dest='format_option', choices=SUPPORTED_FORMATS, help="output format, same as the positional argument")
+    parser.add_argument('-y', '--yes', action='store_true', help="convert without asking for confirmation")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="list the files that would be converted and exit")
+    parser.add_argument('-j', '--jobs', '--workers', type=int, help="conversions to run at once (default: {})".format(WORKERS))
+    parser.add_argument('--sample-rate', type=int, help="sample rate of the raw input (default: {})".format(SETTINGS["frequency"]))
+    parser.add_argument('--channels', type=int, help="channel count of the raw input (default: {})".format(SETTINGS["channels"]))
+    parser.add_argument('--config', help="read convertation_settings from this config.json")
+    parser.add_argument('--encoder', help="auto, native, ffmpeg or a backend name (default: {})".format(SETTINGS["encoder"]))
+    parser.add_argument('--batch-size', type=int, help="files per ffmpeg invocation (default: {})".format(SETTINGS["batch_size"]))
+    parser.add_argument('--pipeline', action='store_true', default=None, help="read, encode and write in separate stages")
+    parser.add_argument('--readers', type=int, help="threads reading raw input (default: {})".format(READERS))
+    parser.add_argument('--writers', type=int, help="threads writing outputs (default: {})".format(WRITERS))
+    parser.add_argument('--io-limit', type=float, help="cap reads and writes at this many MB/s (default: unlimited)")
+    parser.add_argument('--also', action='append', default=[], metavar='FORMAT[:DESTINATION]',
+                        help="also convert to FORMAT in DESTINATION (default: <source>_FORMAT) from the same read; repeatable")
+    parser.add_argument('--profile', help="preprocess with this profile from the config's \"profiles\" (default: none)")
+    parser.add_argument('--hash', choices=['blake2b', 'xxhash'], help="compare content hashes of changed files")
+    parser.add_argument('--verify', action='store_true', help="reconcile the manifest with the destination tree first")
+    parser.add_argument('--watch', action='store_true', help="keep converting new files as they land")
+    parser.add_argument('--stable-ms', type=int, default=STABLE_MS, help="how long a file must stay unchanged in watch mode (default: %(default)s)")
+    parser.add_argument('--json', action='store_true', help="print JSON lines progress events instead of text")
+    parser.add_argument('--metrics-json', help="write per-file metrics and the run summary to this JSON file")
+    parser.add_argument('--metrics-prometheus', help="write the run summary to this Prometheus textfile")
+    parser.add_argument('--coordinator', metavar='[HOST:]PORT',
+                        help="hand pending files out to --worker processes (HOST defaults to 127.0.0.1; use 0.0.0.0 for every interface)")
+    parser.add_argument('--worker', metavar='URL', help="convert files leased from the coordinator at URL")
+    parser.add_argument('--token', default=environ.get('RAW2FLAC_TOKEN'),
+                        help="token shared by the coordinator and its workers (default: $RAW2FLAC_TOKEN; a coordinator makes one up)")
+    parser.add_argument('--lease-size', type=int, default=LEASE_SIZE, help="files per lease (default: %(default)s)")
+    parser.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT,
+                        help="seconds before an unreported lease is handed out again (default: %(default)s)")
+    return parser
+
+if __name__ == "__main__":
+    parser = make_parser()
+    args = parser.parse_args(argv[1:])
+    RESULT_DIRNAME = args.source
+    RESULT_CONVERTED_DIRNAME = args.destination
+    FILE_EXTENSION = '.' + (args.format_option or args.format or FILE_EXTENSION[1:])
+    HASH_NAME = args.hash
+    ASSUME_YES = args.yes or args.json
+    DRY_RUN = args.dry_run
+    VERIFY = args.verify
+    JSON_PROGRESS = args.json
+    METRICS_JSON = args.metrics_json
+    METRICS_PROMETHEUS = args.metrics_prometheus
+    STABLE_MS = max(0, args.stable_ms)
+    LEASE_SIZE_SETTING = max(1, args.lease_size)
+    LEASE_TIMEOUT_SETTING = args.lease_timeout
+    TOKEN = args.token
+    if args.worker and not TOKEN:
+        parser.error("--worker needs the coordinator's --token (or $RAW2FLAC_TOKEN)")
+    if args.config:
+        with open(args.config, "r") as config_file:
+            SETTINGS.update(json.load(config_file)["convertation_settings"])
+        WORKERS = int(SETTINGS.get("workers", WORKERS))
+        HASH_NAME = HASH_NAME or SETTINGS.get("hash")
+    SETTINGS["hash"] = HASH_NAME
+    if args.jobs is not None:
+        WORKERS = args.jobs
+    WORKERS = max(1, WORKERS)
+    for key, value in (("frequency", args.sample_rate), ("channels", args.channels),
+                       ("encoder", args.encoder), ("batch_size", args.batch_size),
+                       ("pipeline", args.pipeline), ("readers", args.readers), ("writers", args.writers), ("io_limit", args.io_limit),
+                       ("profile", args.profile)):
+        if value is not None:
+            SETTINGS[key] = value
+    if SETTINGS.get("profile"):
+        from preprocess import preprocessor_for
+        try:
+            preprocessor_for(SETTINGS)
+        except ValueError as error:
+            parser.error(error)
+    for target in args.also:
+        audio_format, _, destination = target.partition(':')
+        if audio_format not in SUPPORTED_FORMATS:
+            parser.error("--also: unsupported format {}".format(audio_format))
+        EXTRA_TARGETS.append((destination or RESULT_DIRNAME.rstrip('/\\') + '_' + audio_format, '.' + audio_format))
+    if EXTRA_TARGETS and (args.watch or args.worker or args.coordinator):
+        parser.error("--also can't be combined with --watch, --worker or --coordinator")
+    if VERIFY and args.worker:
+        parser.error("--verify is up to the coordinator: workers keep no manifest")
+    if DRY_RUN and (args.watch or args.worker or args.coordinator):
+        parser.error("--dry-run can't be combined with --watch, --worker or --coordinator")
+    # Workers convert to whatever the coordinator asks for.
+    say("Start scaning \n\t{} \nto find source file and convert to {} in folder \n\t{}\n".format(
+        path.realpath(RESULT_DIRNAME), "the coordinator's format" if args.worker else FILE_EXTENSION[1:],
+        path.realpath(RESULT_CONVERTED_DIRNAME)))
+    if not path.exists(RESULT_DIRNAME):
+        say("Can't find result dir with name {}".format(RESULT_DIRNAME))
+        emit("error", message="Can't find result dir with name {}".format(RESULT_DIRNAME))
+        exit(4)
+    if VERIFY and (args.watch or args.coordinator):
+        manifest = Manifest(RESULT_CONVERTED_DIRNAME)
+        try:
+            verify_manifest(manifest, RESULT_CONVERTED_DIRNAME, FILE_EXTENSION)
+        finally:
+            manifest.close()
+    if args.watch:
+        watch_result_tree()
+        exit(0)
+    if args.worker:
+        exit(0 if work_result_tree(args.worker) else 1)
+    if args.coordinator:
+        exit(0 if coordinate_result_tree(args.coordinator) else 1)
+    succeeded = make_result_trees() if EXTRA_TARGETS else make_result_tree()
+    if not ASSUME_YES and not DRY_RUN and stdin.isatty():
+        input("Press enter to quit")
+    exit(0 if succeeded else 1)
@@ -1,27 +1,65 @@
-from os import walk, path, mkdir
+from collections import deque
+from os import path
 from sys import argv, exit
 from datetime import datetime
 
-import subprocess
-import re
 import json
 
 from PyQt5.QtWidgets import QWidget, QFileDialog, QApplication
-from PyQt5.QtCore import pyqtSignal, QThread
+from PyQt5.QtCore import pyqtSignal, QThread, QTimer
 
 from main_ui import Ui_Form
+from pipeline import convert_all
+from manifest import Manifest, repair_manifest
+from encoders import FanoutEncoder, get_encoder, raw_format
+from metrics import RunMetrics
+from journal import Journal, output_settings
+from planner import fanout_resources, plan_conversion, plan_jobs, plan_targets
+from tree_diff import scan_tree
+
+class probeEncodersThread(QThread):
+    # Finds the formats that can be converted without holding up the window:
+    # the native encoders import numpy, and looking for ffmpeg may run it
+    # (ffmpeg_probe caches what it finds on disk for the next launch).
+
+    probed = pyqtSignal(list)
+
+    def __init__(self, audioFormats, settings):
+        QThread.__init__(self)
+        self.audioFormats = audioFormats
+        self.settings = settings
 
-class convertFileThread(QThread):
+    def run(self):
+        available = []
+        for audioFormat in self.audioFormats:
+            try:
+                get_encoder(audioFormat, self.settings)
+            except ValueError:
+                continue
+            available.append(audioFormat)
+        self.probed.emit(available)
 
-    successfullyConvert = pyqtSignal(str, str)
-    failureConvert = pyqtSignal(str, str)
-    successfullyFinish = pyqtSignal()
 
-    def __init__(self, resourceDict, audioFormat, settings):
+class convertFileThread(QThread):
+    # Results are queued as (converted, resourcePath, destinationPath) rather
+    # than signalled one by one: at hundreds of files per second the signals
+    # alone would flood the event loop. The window drains the queue on a timer.
+    # finishConvert(converted, resourcePath, destinationPath) runs in this
+    # thread before a result is queued. With a FanoutEncoder, resourceDict
+    # holds a tuple of destinations per resource, as do the results.
+
+    def __init__(self, resourceDict, audioFormat, settings, startConvert=None, finishConvert=None, encoder=None):
         QThread.__init__(self)
         self.resourceDict = resourceDict
+        self.startConvert = startConvert
+        self.finishConvert = finishConvert
         self.audioFormat = audioFormat
         self.settings = settings
+        self.encoder = encoder or get_encoder(audioFormat, settings)
+        self.metrics = RunMetrics()
+        self.progress = deque()
+        self.completed = False
+        self.summary = ''
         self.needConvertation = True
 
     def __del__(self):
@@ -30,50 +68,44 @@ class convertFileThread(QThread):
     def changeNeedConvertation(self):
         self.needConvertation = False
 
-    def _convert(self, resourcePath, destinationPath):
-        conversion_command = [
-            "ffmpeg",
-            "-y",
-            "-f",
-            "s16le",
-            "-ar",
-            self.settings["frequency"],
-            "-ac",
-            self.settings["channels"],
-            "-i",
-            resourcePath,
-            destinationPath
-        ]
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        p = subprocess.Popen(conversion_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo)
-        p_out, p_err = p.communicate()
-
-        if p.returncode != 0:
-            return False
-        return True
+    def takeProgress(self):
+        results = []
+        while self.progress:
+            results.append(self.progress.popleft())
+        return results
+
+    def convertDone(self, converted, resourcePath, destinationPath):
+        if self.finishConvert is not None:
+            self.finishConvert(converted, resourcePath, destinationPath)
+        self.progress.append((converted, resourcePath, destinationPath))
 
     def run(self):
-        for resPath in self.resourceDict:
-            if self._convert(resPath, self.resourceDict[resPath]):
-                self.successfullyConvert.emit(resPath, self.resourceDict[resPath])
-            else:
-                self.failureConvert.emit(resPath, self.resourceDict[resPath])
-#                print("Handle exception with convert {} to {}".format(resPath, self.resourceDict[resPath]))
-#                try to use sys.exc_info() -> (type, value, traceback)
-            if not self.needConvertation:
-                break
-        else:
-            self.successfullyFinish.emit()
+        self.completed = convert_all(self.resourceDict.items(),
+                                     self.encoder,
+                                     self.settings,
+                                     on_success=lambda resourcePath, destinationPath: self.convertDone(True, resourcePath, destinationPath),
+                                     on_failure=lambda resourcePath, destinationPath: self.convertDone(False, resourcePath, destinationPath),
+                                     should_stop=lambda: not self.needConvertation,
+                                     metrics=self.metrics,
+                                     on_start=self.startConvert)
+        self.metrics.finish()
+        # The summary sorts the timings of every file: done here rather than
+        # on the UI thread.
+        self.summary = self.metrics.format_summary()
+        if self.settings.get("metrics_json"):
+            self.metrics.write_json(self.settings["metrics_json"])
+        if self.settings.get("metrics_prometheus"):
+            self.metrics.write_prometheus(self.settings["metrics_prometheus"])
 
 
 class MainWindow(Ui_Form):
 
-    regexp_kim = re.compile(r"^[0-9]{7}$")
     END_CONVERTATION = 3
     START_CONVERTATION = 2
     SUCCESS = 1
     FAIL = 0
+    PROGRESS_INTERVAL = 100
+    LOG_BLOCKS = 5000
 
     def __init__(self, form):
         self.setupUi(form)
@@ -83,38 +115,58 @@ class MainWindow(Ui_Form):
         self.RESULT_CONVERTED_DIRNAME = ''
         self.FILE_EXTENSION = '.' + self.audioFormatComboBox.currentText()
         self.currentIndex = 0
+        self.manifest = None
+        self.manifests = []
+        self.targets = None
+        self.journal = None
+        self.resume = None
+        self.logFile = None
+        self.informationTextEdit.document().setMaximumBlockCount(self.LOG_BLOCKS)
+        self.progressTimer = QTimer()
+        self.progressTimer.setInterval(self.PROGRESS_INTERVAL)
+        self.progressTimer.timeout.connect(self.drainProgress)
+        self.metricsTimer = QTimer()
+        self.metricsTimer.setInterval(1000)
+        self.metricsTimer.timeout.connect(self.updateMetrics)
 
         self.read_config_file("config.json")
 
-        if self.check_ffmpeg_framework():
-            self.resourceDirectoryDialogButton.clicked.connect(self.showResourceDialog)
-            self.resourceDirectoryLineEdit.textChanged.connect(self.resourceChanged)
-            self.destinationDirectoryDialogButton.clicked.connect(self.showDestinationDialog)
-            self.destinationDirectoryLineEdit.textChanged.connect(self.destinationChanged)
-            self.audioFormatComboBox.currentTextChanged.connect(self.formatChange)
-            self.scanButton.clicked.connect(self.compareTrees)
-            self.convertButton.clicked.connect(self.convert)
-        else:
-            self.informationTextEdit.append("Can't find ffmpeg framework. Ensure that it was installed, added to PATH.".format())
+        self.availableFormats = None
+        self.probeThread = probeEncodersThread([self.audioFormatComboBox.itemText(index) for index in range(self.audioFormatComboBox.count())],
+                                               self.convertation_settings)
+        self.probeThread.probed.connect(self.encodersProbed)
+        self.probeThread.start()
+
+        self.resourceDirectoryDialogButton.clicked.connect(self.showResourceDialog)
+        self.resourceDirectoryLineEdit.textChanged.connect(self.resourceChanged)
+        self.destinationDirectoryDialogButton.clicked.connect(self.showDestinationDialog)
+        self.destinationDirectoryLineEdit.textChanged.connect(self.destinationChanged)
+        self.audioFormatComboBox.currentTextChanged.connect(self.formatChange)
+        self.alsoFormatsCheckBox.stateChanged.connect(self.scanAgain)
+        self.scanButton.clicked.connect(self.compareTrees)
+        self.convertButton.clicked.connect(self.convert)
 
     def read_config_file(self, config_path):
         with open("config.json", "r") as config_file:
             settings_dict = json.load(config_file)
         self.convertation_settings = settings_dict["convertation_settings"]
 
-    def check_ffmpeg_framework(self):
-        try:
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            p = subprocess.Popen(["ffmpeg"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo)
-            p_out, p_err = p.communicate()
-            return True
-        except FileNotFoundError:
-            return False
+    def encodersProbed(self, audioFormats):
+        self.availableFormats = audioFormats
+        if not audioFormats:
+            self.informationTextEdit.append("Can't find ffmpeg framework. Ensure that it was installed, added to PATH.")
+        else:
+            for index in range(self.audioFormatComboBox.count()):
+                if self.audioFormatComboBox.itemText(index) not in audioFormats:
+                    self.informationTextEdit.append("Can't find an encoder for {}. Ensure that ffmpeg was installed, added to PATH.".format(
+                        self.audioFormatComboBox.itemText(index)))
+        self.scanButtonChangeState()
 
     def scanButtonChangeState(self):
+        # Until the probe is back every format is taken to be available.
         parent_dir = self.RESULT_CONVERTED_DIRNAME.partition("\\")[0]
-        self.scanButton.setEnabled(path.isdir(self.RESULT_DIRNAME) and path.isdir(parent_dir))
+        available = self.availableFormats is None or self.FILE_EXTENSION[1:] in self.availableFormats
+        self.scanButton.setEnabled(available and path.isdir(self.RESULT_DIRNAME) and path.isdir(parent_dir))
 
     def resourceChanged(self):
         self.RESULT_DIRNAME = self.resourceDirectoryLineEdit.text()
@@ -126,6 +178,10 @@ class MainWindow(Ui_Form):
 
     def formatChange(self, text):
         self.FILE_EXTENSION = '.' + text
+        self.scanButtonChangeState()
+        self.scanAgain()
+
+    def scanAgain(self):
         if self.convertButton.isEnabled():
             self.convertButton.setEnabled(False)
             self.informationTextEdit.clear()
@@ -153,102 +209,268 @@ class MainWindow(Ui_Form):
         self.scanMessage = """Current result folder contain {} files.
 {} files is already converted to {}.
 Press convert button to start convert another {} files."""
-        result_files = []
-        for root, _, files in walk(self.RESULT_DIRNAME):
-            for filename in files:
-                result_files.append(path.relpath(path.join(root, filename), start=self.RESULT_DIRNAME))
-
-        result_converted_files = []
-        for root, _, files in walk(self.RESULT_CONVERTED_DIRNAME):
-            for filename in files:
-                if filename.endswith(self.FILE_EXTENSION):
-                    result_converted_files.append(path.relpath(path.join(root, filename), start=self.RESULT_CONVERTED_DIRNAME))
-
-        new_files = []
-        for file in result_files:
-            if not file + self.FILE_EXTENSION in result_converted_files:
-                new_files.append(path.normpath(file))
+        for manifest in self.manifests:
+            manifest.close()
+        if self.alsoFormatsCheckBox.isChecked():
+            self.compareTargets()
+            return
+        self.targets = None
+        self.manifest = Manifest(self.RESULT_CONVERTED_DIRNAME)
+        self.manifests = [self.manifest]
+        self.journal = Journal(self.RESULT_CONVERTED_DIRNAME)
+        self.resume = self.journal.resume()
+        if self.resume is not None and self.resume.matches(self.RESULT_DIRNAME,
+                                                           output_settings(self.FILE_EXTENSION, self.convertation_settings)):
+            self.resumeTrees()
+            return
+        self.resume = None
+        # Every scan checks the manifest against the outputs on disk, so that
+        # files whose outputs were deleted (e.g. _duplicate folders once the
+        # conflicts are resolved) are converted again.
+        source = scan_tree(self.RESULT_DIRNAME, stat=True)
+        inputFormat = raw_format(self.convertation_settings)
+        added, removed = repair_manifest(self.RESULT_DIRNAME, self.RESULT_CONVERTED_DIRNAME, self.FILE_EXTENSION,
+                                         self.manifest, source, inputFormat)
+        self.plan = plan_conversion(self.RESULT_DIRNAME, self.RESULT_CONVERTED_DIRNAME, self.FILE_EXTENSION, self.manifest,
+                                    self.convertation_settings.get("hash"), duplicates=True, source=source,
+                                    input_format=inputFormat)
+        self.planned = self.plannedJobs()
 
         self.informationTextEdit.clear()
-        if not new_files:
+        if added or removed:
+            self.informationTextEdit.append("Manifest in {} verified: {} records added, {} records removed".format(
+                self.RESULT_CONVERTED_DIRNAME, added, removed))
+        if not self.plan.jobs:
             self.informationTextEdit.append("All resource from {} is already convert".format(self.RESULT_DIRNAME))
         else:
-            self.new_files = new_files
-            self.informationTextEdit.append(self.scanMessage.format(len(result_files), len(result_converted_files), self.FILE_EXTENSION[1:], len(new_files)))
+            self.informationTextEdit.append(self.scanMessage.format(self.plan.files, self.plan.converted, self.FILE_EXTENSION[1:], len(self.plan.jobs)))
+            self.convertButton.setEnabled(True)
+            self.convertProgressBar.setMaximum(len(self.plan.jobs))
+            self.convertProgressBar.setValue(0)
+            self.currentIndex = 0
+
+    def targetTrees(self):
+        # The chosen format into the destination directory, then every other
+        # format that has an encoder into <Resource Directory>_<format>, as
+        # raw2flac.py --also does.
+        targets = [(self.RESULT_CONVERTED_DIRNAME, self.FILE_EXTENSION)]
+        for index in range(self.audioFormatComboBox.count()):
+            audioFormat = self.audioFormatComboBox.itemText(index)
+            if audioFormat != self.FILE_EXTENSION[1:] and (self.availableFormats is None or audioFormat in self.availableFormats):
+                targets.append((self.RESULT_DIRNAME.rstrip('/\\') + '_' + audioFormat, '.' + audioFormat))
+        return targets
+
+    def compareTargets(self):
+        # Every raw file is read once for all the targets: it is pending when
+        # any of them misses it, and is only encoded for those. As with
+        # raw2flac.py --also there is no journal; an interrupted convertation
+        # is picked up from the manifests.
+        self.targets = self.targetTrees()
+        self.journal = None
+        self.resume = None
+        # Targets sharing a destination tree share its manifest.
+        shared = {}
+        self.manifests = [shared.setdefault(path.realpath(destination), Manifest(destination))
+                          for destination, _ in self.targets]
+        self.manifest = self.manifests[0]
+        source = scan_tree(self.RESULT_DIRNAME, stat=True)
+        inputFormat = raw_format(self.convertation_settings)
+        verified = [repair_manifest(self.RESULT_DIRNAME, destination, extension, manifest, source, inputFormat)
+                    for (destination, extension), manifest in zip(self.targets, self.manifests)]
+        self.plans = plan_targets(self.RESULT_DIRNAME, self.targets, self.manifests, self.convertation_settings.get("hash"),
+                                  duplicates=True, input_format=inputFormat, source=source)
+        self.plan = self.plans[0]
+        self.fanout = fanout_resources(self.plans)
+        self.targetJobs = [{path.join(plan.source_root, job.source): job for job in plan.jobs} for plan in self.plans]
+        self.planned = {}
+        for jobs in reversed(self.targetJobs):
+            self.planned.update(jobs)
+
+        self.informationTextEdit.clear()
+        for (destination, _), (added, removed) in zip(self.targets, verified):
+            if added or removed:
+                self.informationTextEdit.append("Manifest in {} verified: {} records added, {} records removed".format(
+                    destination, added, removed))
+        if not self.fanout:
+            self.informationTextEdit.append("All resource from {} is already convert to {}".format(
+                self.RESULT_DIRNAME, self.targetFormats()))
+        else:
+            self.informationTextEdit.append(self.scanMessage.format(self.plan.files, self.plan.files - len(self.fanout),
+                                                                    self.targetFormats(), len(self.fanout)))
+            for (destination, extension), plan in zip(self.targets, self.plans):
+                self.informationTextEdit.append("\t{} files to {} in {}".format(len(plan.jobs), extension[1:], destination))
             self.convertButton.setEnabled(True)
-            self.convertProgressBar.setMaximum(len(new_files))
+            self.convertProgressBar.setMaximum(len(self.fanout))
             self.convertProgressBar.setValue(0)
             self.currentIndex = 0
 
+    def targetFormats(self):
+        if self.targets is None:
+            return self.FILE_EXTENSION[1:]
+        return ", ".join(extension[1:] for _, extension in self.targets)
+
+    def resumeTrees(self):
+        # An interrupted convertation left its journal: offer to finish it.
+        for job in self.resume.done:
+            self.manifest.record(job.source, job.size, job.mtime_ns, job.output, job.digest)
+        self.manifest.flush()
+        self.plan = plan_jobs(self.RESULT_DIRNAME, self.RESULT_CONVERTED_DIRNAME, self.resume.pending)
+        self.planned = self.plannedJobs()
+        self.informationTextEdit.clear()
+        self.informationTextEdit.append("""Found an interrupted convertation: {} files done, {} files left.
+Press convert button to resume it.""".format(len(self.resume.done), len(self.plan.jobs)))
+        self.convertButton.setEnabled(True)
+        self.convertProgressBar.setMaximum(len(self.plan.jobs))
+        self.convertProgressBar.setValue(0)
+        self.currentIndex = 0
+
+    def plannedJobs(self):
+        # Jobs by the resource path the convertation thread reports them
+        # with, so that the callbacks don't depend on the source field, which
+        # can be edited during a convertation.
+        return {path.join(self.plan.source_root, job.source): job for job in self.plan.jobs}
+
     def convert(self):
-        self.DUPLICATE_FOUND = False
+        self.DUPLICATE_FOUND = bool(self.plan.duplicates)
         self.PPE_ID = self.resourceIdLineEdit.text() if self.resourceIdLineEdit.text() else self.PPE_ID
         self.addLogEntry(self.START_CONVERTATION)
-        resourceDict = {}
-        duplicate_kim_dirs = []
-        if not path.exists(self.RESULT_CONVERTED_DIRNAME):
-            mkdir(self.RESULT_CONVERTED_DIRNAME)
-        for root, dirs, files in walk(self.RESULT_DIRNAME):
-            for dirname in dirs:
-                dirpath = path.join(root, dirname)
-                destination_dirictory_path = path.join(self.RESULT_CONVERTED_DIRNAME, path.relpath(dirpath, start=self.RESULT_DIRNAME))
-                if not path.exists(destination_dirictory_path):
-                    mkdir(destination_dirictory_path)
-                elif self.regexp_kim.fullmatch(dirname):
-                    duplicate_kim_dirs.append(path.relpath(dirpath, start=self.RESULT_DIRNAME))
-            for filename in files:
-                filepath = path.relpath(path.join(root, filename), start=self.RESULT_DIRNAME)
-                if filepath in self.new_files:
-                    dirpath = path.relpath(root, start=self.RESULT_DIRNAME)
-                    if dirpath in duplicate_kim_dirs:
-                        self.DUPLICATE_FOUND = True
-                        destination_file_path = path.join(self.RESULT_CONVERTED_DIRNAME, dirpath + "_duplicate")
-                        print(destination_file_path)
-                        if not path.exists(destination_file_path):
-                            mkdir(destination_file_path)
-                    else:
-                        destination_file_path = path.join(self.RESULT_CONVERTED_DIRNAME, dirpath)
-                    destination_file_path += path.sep + filename + self.FILE_EXTENSION
-                    resource_file_path = path.join(self.RESULT_DIRNAME, filepath)
-                    resourceDict[resource_file_path] = destination_file_path 
+        if self.targets is not None:
+            self.convertTargets()
+            return
+        self.plan.make_dirs()
+        if self.resume is not None:
+            self.resume = None
+            self.journal.reopen()
+        else:
+            self.journal.plan(self.RESULT_DIRNAME, self.plan.jobs, output_settings(self.FILE_EXTENSION, self.convertation_settings))
+        self.startThread(self.plan.largest_first().resources())
+
+    def convertTargets(self):
+        self.DUPLICATE_FOUND = any(plan.duplicates for plan in self.plans)
+        for plan in self.plans:
+            plan.make_dirs()
+            plan.discard_partials()
+        encoder = FanoutEncoder([get_encoder(extension[1:], self.convertation_settings) for _, extension in self.targets])
+        self.startThread(self.fanout, encoder)
+
+    def startThread(self, resourceDict, encoder=None):
         self.convertButton.setEnabled(False)
-        self.thread = convertFileThread(resourceDict, self.FILE_EXTENSION[1:], self.convertation_settings)
-        self.thread.successfullyConvert[str, str].connect(self.convertAnotherOne)
-        self.thread.failureConvert[str, str].connect(self.failConvertation)
-        self.thread.successfullyFinish.connect(self.finishMessage)
+        self.thread = convertFileThread(resourceDict, self.FILE_EXTENSION[1:], self.convertation_settings,
+                                        self.startConvert if self.journal is not None else None, self.finishConvert,
+                                        encoder)
+        self.thread.finished.connect(self.finishConvertation)
+        self.progressTimer.start()
+        self.metricsTimer.start()
         self.convertStopButton.clicked.connect(self.stopConvertation)
         self.convertStopButton.setEnabled(True)
         self.thread.start()
 
+    def startConvert(self, resourcePath, destinationPath):
+        # Called from the convertation thread; the journal is thread safe.
+        self.journal.started(self.planned[resourcePath].source)
+
+    def finishConvert(self, converted, resourcePath, destinationPath):
+        # Called from the convertation thread too: recording an output stats
+        # it and writes to SQLite, which must not hold up the window.
+        if self.targets is not None:
+            self.finishTargets(converted, resourcePath, destinationPath)
+            return
+        job = self.planned[resourcePath]
+        if converted:
+            self.manifest.record(job.source, job.size, job.mtime_ns, job.output,
+                                 self.thread.encoder.digests.pop(resourcePath, job.digest))
+            self.journal.done(job.source)
+        else:
+            self.journal.failed(job.source)
+
+    def finishTargets(self, converted, resourcePath, destinationPaths):
+        # Every target records its own output, also when the convertation
+        # failed for another target.
+        encoder = self.thread.encoder
+        written = destinationPaths if converted else encoder.written.pop(resourcePath, ())
+        digest = encoder.digests.pop(resourcePath, None)
+        for manifest, jobs, destinationPath in zip(self.manifests, self.targetJobs, destinationPaths):
+            job = jobs.get(resourcePath)
+            if job is not None and destinationPath in written:
+                manifest.record(job.source, job.size, job.mtime_ns, job.output, digest or job.digest)
+
     def stopConvertation(self):
         self.thread.changeNeedConvertation()
         self.convertStopButton.setEnabled(False)
 
+    def drainProgress(self):
+        # Applies everything converted since the last tick with one text
+        # append, one progress bar update and one log flush.
+        results = self.thread.takeProgress()
+        if not results:
+            return
+        messages = []
+        for converted, resourcePath, destinationPath in results:
+            if converted:
+                messages.append(self.convertAnotherOne(resourcePath, destinationPath))
+            else:
+                messages.append(self.failConvertation(resourcePath, destinationPath))
+        self.informationTextEdit.append("\n".join(messages))
+        self.convertProgressBar.setValue(self.convertProgressBar.value() + sum(converted for converted, _, _ in results))
+        self.logFile.flush()
+
     def convertAnotherOne(self, resourcePath, destinationPath):
-        self.informationTextEdit.append("File from:\n\t{} \nsuccessfully convert to \n\t{}\n\n.".format(resourcePath, destinationPath))
-        self.convertProgressBar.setValue(self.convertProgressBar.value() + 1)
         self.addLogEntry(self.SUCCESS, resourcePath, destinationPath)
+        if self.targets is not None:
+            destinationPath = "\n\t".join(output for output in destinationPath if output)
+        return "File from:\n\t{} \nsuccessfully convert to \n\t{}\n\n.".format(resourcePath, destinationPath)
 
     def failConvertation(self, resourcePath, destinationPath):
-        self.informationTextEdit.append("ATTENTION:\nFile from:\n\t{} \n failed to convert")
         self.addLogEntry(self.FAIL, resourcePath, destinationPath)
+        return "ATTENTION:\nFile from:\n\t{} \n failed to convert".format(resourcePath)
 
     def addLogEntry(self, status, resourcePath="", destinationPath=""):
-        with open("convertation.log", "a") as log:
-            if status == self.SUCCESS:
-                log.write("{}:\t{} successfully convert\n".format(datetime.now().ctime(), path.relpath(resourcePath, start=self.RESULT_DIRNAME))) 
-            elif status == self.FAIL:
-                log.write("{}:\t{} failed to convert\n".format(datetime.now().ctime(), path.relpath(resourcePath, start=self.RESULT_DIRNAME)))
-            elif status == self.START_CONVERTATION:
-                log.write("{}: start to convert resources from {}\n".format(datetime.now().ctime(), self.PPE_ID))
-            elif status == self.END_CONVERTATION:
-                log.write("{}: convertation finish.\n{}\n".format(datetime.now().ctime(), "_"*80))
+        # convertation.log stays open for the session; it is flushed with
+        # every progress update instead of being reopened for every file.
+        if self.logFile is None:
+            self.logFile = open("convertation.log", "a")
+        if status == self.SUCCESS:
+            self.logFile.write("{}:\t{} successfully convert\n".format(datetime.now().ctime(), self.planned[resourcePath].source)) 
+        elif status == self.FAIL:
+            self.logFile.write("{}:\t{} failed to convert\n".format(datetime.now().ctime(), self.planned[resourcePath].source))
+        elif status == self.START_CONVERTATION:
+            self.logFile.write("{}: start to convert resources from {}\n".format(datetime.now().ctime(), self.PPE_ID))
+        elif status == self.END_CONVERTATION:
+            self.logFile.write("{}: convertation finish.\n{}\n".format(datetime.now().ctime(), "_"*80))
+
+    def updateMetrics(self):
+        # Every second on the UI thread: only the cheap live figures.
+        live = self.thread.metrics.live()
+        self.informationLabel.setText("Information: {:.1f} files/s, {:.2f} MB/s, p95 {:.3f}s per file".format(
+            live['files_per_second'], live['mb_per_second'], live['recent_p95']))
+
+    def finishMetrics(self):
+        self.metricsTimer.stop()
+        self.updateMetrics()
+        self.informationTextEdit.append(self.thread.summary)
+
+    def finishConvertation(self):
+        self.progressTimer.stop()
+        self.drainProgress()
+        for manifest in self.manifests:
+            manifest.flush()
+        if self.journal is None:
+            if self.thread.completed:
+                self.finishMessage()
+        elif self.thread.completed:
+            self.journal.complete()
+            self.finishMessage()
+        else:
+            self.journal.sync()
+            self.journal.close()
+        self.finishMetrics()
+        self.logFile.flush()
 
     def finishMessage(self):
         if self.DUPLICATE_FOUND:
-            self.informationTextEdit.append("Convertation to {} finish, but found duplicates.\nResolve conflicts and remove duplicate folders before next convertation".format(self.FILE_EXTENSION[1:]))
+            self.informationTextEdit.append("Convertation to {} finish, but found duplicates.\nResolve conflicts and remove duplicate folders before next convertation".format(self.targetFormats()))
         else:
-            self.informationTextEdit.append("Convertation to {} successfully finish".format(self.FILE_EXTENSION[1:]))
+            self.informationTextEdit.append("Convertation to {} successfully finish".format(self.targetFormats()))
         self.addLogEntry(self.END_CONVERTATION)
         self.convertStopButton.setEnabled(False)
 
@@ -0,0 +1,47 @@
+from collections import deque, namedtuple
+from os import scandir, path
+
+TreeIndex = namedtuple('TreeIndex', ['dirs', 'files', 'stats'], defaults=[None])
+TreeDiff = namedtuple('TreeDiff', ['source', 'destination', 'new_files', 'digests'], defaults=[None])
+
+
+def scan_tree(root, extension='', stat=False):
+    # Breadth-first walk with os.scandir. Paths are relative to root, so both
+    # trees can be compared without realpath calls; a missing root is empty.
+    # With stat=True the (size, mtime_ns) of every file is collected as well.
+    dirs = []
+    files = []
+    stats = {} if stat else None
+    queue = deque([''])
+    while queue:
+        relroot = queue.popleft()
+        try:
+            entries = scandir(path.join(root, relroot) if relroot else root)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                relpath = path.join(relroot, entry.name) if relroot else entry.name
+                if entry.is_dir():
+                    dirs.append(relpath)
+                    if not entry.is_symlink():
+                        queue.append(relpath)
+                elif entry.name.endswith(extension):
+                    if stat:
+                        # Dangling symlinks and files deleted since the
+                        # directory was read are left out.
+                        try:
+                            entry_stat = entry.stat()
+                        except OSError:
+                            continue
+                        stats[relpath] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+                    files.append(relpath)
+    return TreeIndex(dirs, files, stats)
+
+
+def diff_trees(source_root, destination_root, extension):
+    source = scan_tree(source_root)
+    destination = scan_tree(destination_root, extension)
+    converted = set(destination.files)
+    new_files = [relpath for relpath in source.files if relpath + extension not in converted]
+    return TreeDiff(source, destination, new_files)
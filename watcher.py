@@ -0,0 +1,143 @@
+from os import path, stat
+from time import monotonic, sleep
+
+from tree_diff import scan_tree
+
+STABLE_MS = 2000
+POLL_INTERVAL = 5.0
+
+
+def _file_stat(filepath):
+    try:
+        file_stat = stat(filepath)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+class PollingChanges:
+    # Rescans the tree every poll_interval seconds and reports files that are
+    # new or whose size/mtime changed since the previous scan.
+
+    def __init__(self, root, poll_interval=POLL_INTERVAL):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.snapshot = scan_tree(root, stat=True).stats
+
+    def read(self, timeout):
+        sleep(min(timeout, self.poll_interval))
+        stats = scan_tree(self.root, stat=True).stats
+        changed = [relpath for relpath, file_stat in stats.items() if self.snapshot.get(relpath) != file_stat]
+        self.snapshot = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyChanges:
+    # Same interface as PollingChanges, driven by inotify events. Watches are
+    # added for every directory, including ones created while watching. A
+    # directory that can't be watched (most often max_user_watches is used
+    # up) would never report its files: the constructor raises then, and a
+    # tree outgrowing the limit later is polled from then on.
+
+    def __init__(self, root, poll_interval=POLL_INTERVAL):
+        from inotify_simple import INotify, flags
+        self.flags = flags
+        self.mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+        self.root = root
+        self.poll_interval = poll_interval
+        self.polling = None
+        self.inotify = INotify()
+        self.dirs = {}
+        self.unwatched = None
+        for dirname in [''] + scan_tree(root).dirs:
+            self._watch(dirname)
+        if self.unwatched is not None:
+            self.inotify.close()
+            raise self.unwatched
+
+    def _watch(self, relpath):
+        try:
+            wd = self.inotify.add_watch(path.join(self.root, relpath) if relpath else self.root, self.mask)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed since it was listed.
+            return
+        except OSError as error:
+            self.unwatched = error
+            return
+        self.dirs[wd] = relpath
+
+    def read(self, timeout):
+        if self.polling is not None:
+            return self.polling.read(timeout)
+        changed = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            relroot = self.dirs.get(event.wd)
+            if relroot is None or not event.name:
+                continue
+            relpath = path.join(relroot, event.name) if relroot else event.name
+            if event.mask & self.flags.ISDIR:
+                # Files may land in a new directory before its watch exists.
+                self._watch(relpath)
+                index = scan_tree(path.join(self.root, relpath))
+                for dirname in index.dirs:
+                    self._watch(path.join(relpath, dirname))
+                changed += [path.join(relpath, filename) for filename in index.files]
+            else:
+                changed.append(relpath)
+        if self.unwatched is not None:
+            # Files in directories that aren't watched are left out of the
+            # snapshot, so the first poll lists what landed there since.
+            self.inotify.close()
+            self.polling = PollingChanges(self.root, self.poll_interval)
+            watched = set(self.dirs.values())
+            self.polling.snapshot = {relpath: file_stat for relpath, file_stat in self.polling.snapshot.items()
+                                     if path.dirname(relpath) in watched}
+        return changed
+
+    def close(self):
+        if self.polling is None:
+            self.inotify.close()
+
+
+def open_changes(root, poll_interval=POLL_INTERVAL):
+    try:
+        return InotifyChanges(root, poll_interval)
+    except (ImportError, OSError):
+        return PollingChanges(root, poll_interval)
+
+
+def watch_tree(root, on_ready, stable_ms=STABLE_MS, should_stop=None, poll_interval=POLL_INTERVAL, initial=None):
+    # Calls on_ready({relpath: (size, mtime_ns)}) with files that changed and
+    # then kept the same size and mtime for stable_ms, i.e. that the capture
+    # node has finished writing. Runs until should_stop() is true. initial()
+    # is called once changes are being watched and returns files that are
+    # already pending (a scan of the tree); they wait to be stable as well,
+    # and nothing that lands meanwhile is missed.
+    changes = open_changes(root, poll_interval)
+    candidates = {}
+    stable = stable_ms / 1000
+    try:
+        if initial is not None:
+            for relpath in initial():
+                candidates[relpath] = (None, 0)
+        while should_stop is None or not should_stop():
+            for relpath in changes.read(stable / 2 if candidates else 1.0):
+                candidates[relpath] = (None, 0)
+            ready = {}
+            now = monotonic()
+            for relpath, (last_stat, since) in list(candidates.items()):
+                file_stat = _file_stat(path.join(root, relpath))
+                if file_stat is None:
+                    del candidates[relpath]
+                elif file_stat != last_stat:
+                    candidates[relpath] = (file_stat, now)
+                elif now - since >= stable:
+                    ready[relpath] = file_stat
+                    del candidates[relpath]
+            if ready:
+                on_ready(ready)
+    finally:
+        changes.close()